@@ -0,0 +1,113 @@
+"""Замер этапа нечёткого сопоставления SampleNameMatcher._match_by_similarity.
+
+Сравнивает индексированный поиск с полным перебором SequenceMatcher.ratio()
+по всем парам. Полный перебор выполняется на первых --reference-limit
+названиях протоколов (на 5k×5k он занимает слишком много времени), по ним же
+проверяется совпадение принятых сопоставлений.
+
+    python benchmarks/bench_fuzzy_matching.py --size 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from difflib import SequenceMatcher
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import SampleNameMatcher  # noqa: E402
+
+SURFACE_TYPES = ['ЭПК', 'ШПП', 'ПС КШ', 'КПП ВД', 'КПП НД-1', 'КПП НД-2']
+LETTERS = 'АБВГ'
+
+
+def make_names(size, seed):
+    rnd = random.Random(seed)
+    correct_names = []
+    protocol_names = []
+    for number in range(1, size + 1):
+        name = f"{rnd.choice(SURFACE_TYPES)} ряд {rnd.randint(1, 40)} п.{number} {rnd.choice(LETTERS)}"
+        correct_names.append({'number': number, 'original': name})
+        noisy = list(name)
+        for _ in range(rnd.randint(0, 3)):
+            position = rnd.randrange(len(noisy))
+            action = rnd.random()
+            if action < 0.4:
+                del noisy[position]
+            elif action < 0.7:
+                noisy.insert(position, rnd.choice('АБВГДЕКМНПРСТ0123456789 '))
+            else:
+                noisy[position] = rnd.choice('АБВГДЕКМНПРСТ0123456789')
+        protocol_names.append(''.join(noisy))
+    rnd.shuffle(protocol_names)
+    return [{'name': name, 'original_name': name} for name in protocol_names], correct_names
+
+
+def reference_similarity(matcher, protocol_samples, correct_samples, threshold):
+    """Исходный алгоритм: полный перебор всех неиспользованных названий"""
+    used_correct = set()
+    matches = []
+    for protocol in protocol_samples:
+        protocol_norm = matcher.normalize_text(protocol['name'])
+        best = None
+        best_score = 0
+        for correct in correct_samples:
+            if correct['original'] in used_correct:
+                continue
+            score = SequenceMatcher(None, protocol_norm, matcher.normalize_text(correct['original'])).ratio()
+            if score > best_score:
+                best_score = score
+                best = correct
+        if best is not None and best_score >= threshold:
+            matches.append((protocol['name'], best['number']))
+            used_correct.add(best['original'])
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=5000, help='число названий в каждом списке')
+    parser.add_argument('--reference-limit', type=int, default=200,
+                        help='сколько названий протоколов сопоставлять полным перебором')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    protocol_samples, correct_samples = make_names(args.size, args.seed)
+    matcher = SampleNameMatcher()
+    # Признаки, которые parse_correct_names добавляет к каждому правильному названию
+    for correct in correct_samples:
+        correct.update({
+            'surface_type': matcher.extract_surface_type(correct['original']),
+            'tube_number': matcher.extract_tube_number_from_correct(correct['original']),
+            'letter': matcher.extract_letter(correct['original'])
+        })
+
+    start = time.perf_counter()
+    matches = matcher._match_by_similarity(protocol_samples, matcher.correct_name_set(correct_samples), set())
+    indexed_time = time.perf_counter() - start
+    print(f"Индексированный поиск: {args.size}×{args.size} за {indexed_time:.2f} с, "
+          f"сопоставлено {len(matches)}")
+
+    subset = protocol_samples[:args.reference_limit]
+    start = time.perf_counter()
+    reference = reference_similarity(matcher, subset, correct_samples, matcher.similarity_threshold)
+    reference_time = time.perf_counter() - start
+
+    matcher = SampleNameMatcher()
+    start = time.perf_counter()
+    subset_matches = matcher._match_by_similarity(subset, matcher.correct_name_set(correct_samples), set())
+    subset_time = time.perf_counter() - start
+    subset_matches = [(protocol['name'], correct['number']) for protocol, correct, _ in subset_matches]
+
+    print(f"Полный перебор: {len(subset)}×{args.size} за {reference_time:.2f} с, "
+          f"индексированный на том же наборе — {subset_time:.2f} с "
+          f"(ускорение ×{reference_time / max(subset_time, 1e-9):.0f})")
+    print(f"Оценка полного перебора {args.size}×{args.size}: "
+          f"{reference_time * args.size / max(len(subset), 1):.0f} с")
+    print('Сопоставления совпадают' if reference == subset_matches else 'ОШИБКА: сопоставления различаются')
+    return 0 if reference == subset_matches else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""Замер времени импорта модулей приложения в отдельных процессах.
+
+Показывает медиану по нескольким запускам и то, какие тяжёлые зависимости
+(streamlit, pandas, docx) оказываются загружены после импорта.
+
+    python benchmarks/bench_import_time.py core cli app --runs 7
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['streamlit', 'pandas', 'numpy', 'docx']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module, runs):
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        loaded = result['loaded']
+    return statistics.median(timings), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=['core', 'cli'])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        seconds, loaded = measure(module, args.runs)
+        print(f"{module}: {seconds * 1000:.0f} мс, загружены: {', '.join(loaded) or 'нет'}")
+
+
+if __name__ == '__main__':
+    main()
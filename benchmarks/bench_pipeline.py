@@ -0,0 +1,186 @@
+"""Замер этапов обработки на синтетических данных разного объёма.
+
+Для каждого размера (по умолчанию 10, 100, 1000 и 10 000 образцов) данные
+генерируются benchmarks/synthetic.py, после чего замеряются: разбор
+протоколов, загрузка правильных названий, каждый из четырёх этапов
+сопоставления, глобальное назначение названий, построение таблиц отчёта,
+оформление таблиц (Styler в HTML) и формирование Word-отчёта. Берётся
+лучшее время из --repeat запусков.
+
+Результаты сохраняются в JSON (по умолчанию benchmarks/results/), а с
+--compare сравниваются с ранее сохранённым файлом: этапы, ставшие медленнее
+более чем в --threshold раз, отмечаются как регрессии.
+
+    python benchmarks/bench_pipeline.py --sizes 10 100 1000 --repeat 3
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/pipeline-20240101-120000.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from core import ChemicalAnalyzer, SampleNameMatcher, build_word_report  # noqa: E402
+from synthetic import correct_names_docx, make_dataset, protocol_docx  # noqa: E402
+
+STAGES = [
+    'parse', 'correct_names',
+    'match_tube_type_letter', 'match_tube_type', 'match_tube', 'match_similarity', 'match_global',
+    'report_tables', 'styling', 'word_report'
+]
+
+
+def best_time(func, repeat):
+    """Лучшее время и результат последнего запуска"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_size(size, repeat, seed):
+    correct_names, protocols = make_dataset(size, seed=seed)
+    protocol_files = [protocol_docx(samples, seed=seed + index) for index, samples in enumerate(protocols)]
+    correct_file = correct_names_docx(correct_names)
+    timings = {}
+
+    analyzer = ChemicalAnalyzer()
+    timings['parse'], parsed = best_time(
+        lambda: [sample for content in protocol_files for sample in analyzer.parse_protocol_document(content)], repeat
+    )
+
+    # Новый SampleNameMatcher на каждый запуск: реестр и кэши признаков не должны влиять на замер
+    timings['correct_names'], correct_set = best_time(
+        lambda: SampleNameMatcher().load_correct_names(correct_file), repeat
+    )
+
+    matcher = SampleNameMatcher()
+    correct_set = matcher.load_correct_names(correct_file)
+    for name, _ in matcher.match_stages():
+        timings[f'match_{name}'] = None
+    for _ in range(repeat):
+        # Кэш признаков названий протоколов прогревается первым запуском, как при повторных перезапусках интерфейса
+        unmatched = list(parsed)
+        used_correct = set()
+        for name, stage in matcher.match_stages():
+            start = time.perf_counter()
+            matches = stage(unmatched, correct_set, used_correct)
+            elapsed = time.perf_counter() - start
+            key = f'match_{name}'
+            timings[key] = elapsed if timings[key] is None else min(timings[key], elapsed)
+            matched_ids = {id(match[0]) for match in matches}
+            unmatched = [sample for sample in unmatched if id(sample) not in matched_ids]
+
+    global_matcher = SampleNameMatcher()
+    global_matcher.assignment = 'global'
+    global_set = global_matcher.load_correct_names(correct_file)
+    timings['match_global'], _ = best_time(lambda: global_matcher.match_samples(parsed, global_set), repeat)
+
+    analyzer = ChemicalAnalyzer(name_matcher=matcher)
+    samples = analyzer.match_sample_names(parsed, correct_set)
+    timings['report_tables'], report_tables = best_time(lambda: analyzer.create_report_tables(samples), repeat)
+
+    def render_styled():
+        return [
+            analyzer.apply_styling(table_data['data'], table_data['compliance']).to_html()
+            for table_data in (report_tables or {}).values()
+        ]
+
+    timings['styling'], _ = best_time(render_styled, repeat)
+    timings['word_report'], _ = best_time(lambda: build_word_report(samples, report_tables or {}), repeat)
+
+    matched = sum(1 for sample in samples if sample.get('correct_number') is not None)
+    return {'samples': len(parsed), 'protocols': len(protocol_files), 'matched': matched, 'seconds': timings}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    sizes = list(results)
+    print(f"{'этап':<24}" + ''.join(f"{size:>12}" for size in sizes))
+    for stage in STAGES:
+        print(f"{stage:<24}" + ''.join(f"{results[size]['seconds'][stage] * 1000:>10.1f}мс" for size in sizes))
+
+
+def compare(results, baseline, threshold):
+    """Этапы, ставшие медленнее в threshold раз и более; очень быстрые этапы не сравниваются"""
+    regressions = []
+    print(f"\nСравнение с {baseline['created_at']} ({baseline.get('revision') or 'ревизия неизвестна'}):")
+    for size, result in results.items():
+        previous = baseline['results'].get(str(size))
+        if previous is None:
+            continue
+        for stage in STAGES:
+            old = previous['seconds'].get(stage)
+            new = result['seconds'][stage]
+            if not old or max(old, new) < 0.001:
+                continue
+            ratio = new / old
+            mark = ''
+            if ratio >= threshold:
+                mark = '  ← регрессия'
+                regressions.append((size, stage, ratio))
+            print(f"  {size:>6} {stage:<24} {old * 1000:>9.1f} → {new * 1000:>9.1f} мс  ×{ratio:.2f}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='числа образцов')
+    parser.add_argument('--repeat', type=int, default=3, help='запусков на этап, берётся лучшее время')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='файл результатов JSON (по умолчанию benchmarks/results/pipeline-<время>.json)')
+    parser.add_argument('--compare', help='ранее сохранённый файл результатов для сравнения')
+    parser.add_argument('--threshold', type=float, default=1.2, help='замедление, считающееся регрессией')
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        results[size] = bench_size(size, args.repeat, args.seed)
+        print(f"{size} образцов: {results[size]['protocols']} протоколов, сопоставлено {results[size]['matched']}",
+              file=sys.stderr)
+    print_results(results)
+
+    created_at = datetime.now()
+    output = args.output or os.path.join(BENCH_DIR, 'results', f"pipeline-{created_at.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'created_at': created_at.isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'results': {str(size): result for size, result in results.items()}
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"Регрессий: {len(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""Замер формирования Word-отчёта build_word_report.
+
+Сравнивает запись таблиц одним OOXML-фрагментом (add_report_table) с прежней
+поячеечной записью через table.cell(i, j).text и обходом всех абзацев для
+шрифта. Проверяет, что тексты ячеек в обоих отчётах совпадают.
+
+    python benchmarks/bench_word_report.py --rows 2000
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import ChemicalAnalyzer, build_word_report  # noqa: E402
+
+GRADES = ['12Х1МФ', '20', '12Х18Н12Т']
+
+
+def make_samples(rows, seed):
+    rnd = random.Random(seed)
+    analyzer = ChemicalAnalyzer()
+    samples = []
+    for number in range(1, rows + 1):
+        grade = GRADES[number % len(GRADES)]
+        elements = [elem for elem in analyzer.standards[grade] if elem != 'source']
+        samples.append({
+            'name': f"ЭПК ряд {rnd.randint(1, 40)} п.{number} {rnd.choice('АБВГ')}",
+            'original_name': f"Образец {number}",
+            'steel_grade': grade,
+            'composition': {elem: rnd.uniform(0.001, 2.5) for elem in elements if rnd.random() < 0.95},
+            'correct_number': number
+        })
+    return samples, analyzer.create_report_tables(samples)
+
+
+def legacy_build_word_report(samples, report_tables):
+    """Прежний способ: шрифт у каждого run и запись каждой ячейки через table.cell()"""
+    from docx import Document
+
+    doc = Document()
+    for style in doc.styles:
+        if hasattr(style, 'font'):
+            style.font.name = 'Times New Roman'
+    doc.add_heading('Протокол анализа химического состава', 0)
+    for grade, table_data in report_tables.items():
+        doc.add_heading(f'Марка стали: {grade}', level=1)
+        df = table_data['data']
+        word_table = doc.add_table(rows=len(df) + 1, cols=len(df.columns))
+        word_table.style = 'Table Grid'
+        for j, col in enumerate(df.columns):
+            word_table.cell(0, j).text = str(col)
+        for i, row in df.iterrows():
+            for j, col in enumerate(df.columns):
+                word_table.cell(i + 1, j).text = str(row[col])
+        doc.add_paragraph()
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                for paragraph in cell.paragraphs:
+                    for run in paragraph.runs:
+                        run.font.name = 'Times New Roman'
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
+
+
+def table_texts(content, skip=0):
+    from docx import Document
+
+    doc = Document(io.BytesIO(content))
+    return [[[cell.text for cell in row.cells] for row in table.rows] for table in doc.tables[skip:]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000, help='число образцов в отчёте')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    samples, report_tables = make_samples(args.rows, args.seed)
+
+    start = time.perf_counter()
+    legacy = legacy_build_word_report(samples, report_tables)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report = build_word_report(samples, report_tables)
+    bulk_time = time.perf_counter() - start
+
+    print(f"Поячеечная запись: {args.rows} строк за {legacy_time:.2f} с")
+    print(f"OOXML-фрагментом: {args.rows} строк за {bulk_time:.2f} с "
+          f"(ускорение ×{legacy_time / max(bulk_time, 1e-9):.1f})")
+    # Первая таблица нового отчёта — легенда
+    same = table_texts(legacy) == table_texts(report, skip=1)
+    print('Тексты ячеек совпадают' if same else 'ОШИБКА: тексты ячеек различаются')
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""Синтетические протоколы химического анализа и списки правильных названий.
+
+Протоколы повторяют разметку, которую ожидает ChemicalAnalyzer: абзац
+«Наименование образца: …», фраза с маркой стали и таблица 13×9 с элементами
+в строках 0 и 7 и значениями в строках 5 и 12. Названия в протоколах —
+зашумлённые варианты правильных названий: другие написания типа
+поверхности, сокращения, опечатки и посторонние образцы.
+
+    python benchmarks/synthetic.py каталог --size 1000 --per-protocol 10
+
+Файлы собираются из OOXML-фрагментов, поэтому даже 10 000 образцов
+генерируются за секунды.
+"""
+import argparse
+import io
+import os
+import random
+import sys
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import BUILTIN_STANDARDS  # noqa: E402
+
+SURFACE_VARIANTS = {
+    'ЭПК': ['ЭПК', 'эпк'],
+    'ШПП': ['ШПП', 'шпп'],
+    'ПС КШ': ['ПС КШ', 'ПТКМ', 'труба_ПТКМ', 'ПТ КШ'],
+    'КПП ВД': ['КПП ВД', 'ВД'],
+    'КПП НД-1': ['КПП НД-1', 'НД-I', 'КПП НД-I'],
+    'КПП НД-2': ['КПП НД-2', 'НД-IIст', 'КПП НД-II'],
+}
+LETTERS = 'АБВГ'
+GRADE_SENTENCES = [
+    'Химический состав металла образца соответствует марке стали: {grade}',
+    'Химический состав металла образца близок к марке стали: {grade}**, ',
+    'По результатам анализа металл относится к марке стали: {grade}',
+]
+HEADERS = (['', 'C', 'Si', 'Mn', 'P', 'S', 'Cr', 'Mo', 'Ni'], ['', 'Cu', 'Al', 'Co', 'Nb', 'Ti', 'V', 'W', 'Fe'])
+TABLE_ROWS = 13
+
+
+def make_correct_names(size, rnd):
+    """Правильные названия: тип поверхности, труба и нитка"""
+    names = []
+    for number in range(1, size + 1):
+        surface_type = rnd.choice(list(SURFACE_VARIANTS))
+        names.append({
+            'number': number,
+            'original': f"{surface_type} тр.{rnd.randint(1, max(40, size // 4))} Н{rnd.choice(LETTERS)}",
+            'surface_type': surface_type
+        })
+    return names
+
+
+def noisy_name(correct, rnd, noise):
+    """Название образца в протоколе для правильного названия correct"""
+    tube = correct['original'].split('тр.')[1].split()[0]
+    letter = correct['original'][-1]
+    variant = rnd.choice(SURFACE_VARIANTS[correct['surface_type']])
+    kind = rnd.random()
+    if kind < 0.5:
+        name = f"{variant} тр {tube} н{letter}"
+    elif kind < 0.7:
+        name = f"{variant} труба №{tube}"
+    else:
+        name = f"{correct['original']} обр"
+    chars = list(name)
+    for _ in range(sum(rnd.random() < noise for _ in range(3))):
+        position = rnd.randrange(len(chars))
+        action = rnd.random()
+        if action < 0.4 and len(chars) > 1:
+            del chars[position]
+        elif action < 0.7:
+            chars.insert(position, rnd.choice('абвгдекмнпрст0123456789 '))
+        else:
+            chars[position] = rnd.choice('абвгдекмнпрст0123456789')
+    return ''.join(chars).strip()
+
+
+def make_composition(grade, rnd, deviation_rate):
+    """Состав около границ норматива марки; с вероятностью deviation_rate элемент выходит за них"""
+    standard = BUILTIN_STANDARDS[grade]
+    composition = {}
+    for element in HEADERS[0][1:] + HEADERS[1][1:]:
+        low, high = standard.get(element, (None, None))
+        low = low if low is not None else 0.0
+        high = high if high is not None else max(low * 2, 0.3)
+        if rnd.random() < deviation_rate:
+            value = high * rnd.uniform(1.05, 1.5) if rnd.random() < 0.7 else low * rnd.uniform(0.5, 0.95)
+        else:
+            value = rnd.uniform(low, high)
+        composition[element] = round(value, 3)
+    return composition
+
+
+def make_dataset(size, seed=0, per_protocol=10, noise=0.3, foreign_rate=0.05, deviation_rate=0.05):
+    """Правильные названия и протоколы: список протоколов, каждый — список образцов
+    с ключами name, steel_grade, composition и expected_number — номером правильного
+    названия, от которого получено название (None для посторонних образцов)"""
+    rnd = random.Random(seed)
+    correct_names = make_correct_names(size, rnd)
+    grades = list(BUILTIN_STANDARDS)
+    samples = []
+    for correct in correct_names:
+        expected_number = correct['number']
+        if rnd.random() < foreign_rate:
+            name = f"образец {rnd.randint(1, 9999)} {rnd.choice(['x', 'ЭП', 'К'])}"
+            expected_number = None
+        else:
+            name = noisy_name(correct, rnd, noise)
+        grade = rnd.choice(grades)
+        samples.append({
+            'name': name, 'steel_grade': grade, 'composition': make_composition(grade, rnd, deviation_rate),
+            'expected_number': expected_number
+        })
+    rnd.shuffle(samples)
+    protocols = [samples[start:start + per_protocol] for start in range(0, len(samples), per_protocol)]
+    return correct_names, protocols
+
+
+def paragraph_xml(text):
+    """Абзац OOXML с текстом text"""
+    return f'<w:p><w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r></w:p>'
+
+
+def format_value(value):
+    """Значение состава, как оно записано в протоколе: три знака, десятичная запятая"""
+    return f"{value:.3f}".replace('.', ',')
+
+
+def _composition_table(composition, rnd):
+    rows = [[''] * len(HEADERS[0]) for _ in range(TABLE_ROWS)]
+    rows[0], rows[7] = list(HEADERS[0]), list(HEADERS[1])
+    rows[1][0], rows[8][0] = 'Элемент', 'Элемент'
+    for value_row, headers in ((5, HEADERS[0]), (12, HEADERS[1])):
+        rows[value_row][0] = 'Среднее'
+        for column, element in enumerate(headers[1:], 1):
+            uncertainty = format_value(max(composition[element] * 0.03, 0.001))
+            text = format_value(composition[element])
+            rows[value_row][column] = f"{text} ± {uncertainty}" if rnd.random() < 0.5 else text
+    grid = ''.join('<w:gridCol w:w="900"/>' for _ in HEADERS[0])
+    body = ''.join(
+        '<w:tr>' + ''.join(f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="900"/></w:tcPr>{paragraph_xml(cell)}</w:tc>' for cell in row) + '</w:tr>'
+        for row in rows
+    )
+    return f'<w:tbl><w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/></w:tblPr><w:tblGrid>{grid}</w:tblGrid>{body}</w:tbl>'
+
+
+def document_docx(body_xml):
+    """Файл .docx с фрагментом OOXML body_xml в теле документа"""
+    from docx import Document
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+
+    doc = Document()
+    fragment = parse_xml(f"<w:body {nsdecls('w')}>{body_xml}</w:body>")
+    sect_pr = doc.element.body.sectPr
+    for element in list(fragment):
+        sect_pr.addprevious(element)
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
+
+
+def protocol_docx(samples, seed=0):
+    """Протокол .docx с образцами samples"""
+    rnd = random.Random(seed)
+    parts = [paragraph_xml('ПРОТОКОЛ № 1 определения химического состава металла')]
+    for sample in samples:
+        parts.append(paragraph_xml(f"Наименование образца: {sample['name']}"))
+        parts.append(paragraph_xml(rnd.choice(GRADE_SENTENCES).format(grade=sample['steel_grade'])))
+        parts.append(_composition_table(sample['composition'], rnd))
+        parts.append(paragraph_xml(''))
+    return document_docx(''.join(parts))
+
+
+def correct_names_docx(correct_names):
+    """Файл правильных названий: таблица «номер — название»"""
+    rows = ''.join(
+        '<w:tr>' + ''.join(
+            f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="4000"/></w:tcPr>{paragraph_xml(text)}</w:tc>'
+            for text in (str(correct['number']), correct['original'])
+        ) + '</w:tr>'
+        for correct in correct_names
+    )
+    table = (
+        '<w:tbl><w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/></w:tblPr>'
+        f'<w:tblGrid><w:gridCol w:w="4000"/><w:gridCol w:w="4000"/></w:tblGrid>{rows}</w:tbl>'
+    )
+    return document_docx(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help='каталог для файлов')
+    parser.add_argument('--size', type=int, default=100, help='число образцов')
+    parser.add_argument('--per-protocol', type=int, default=10, help='образцов в одном протоколе')
+    parser.add_argument('--noise', type=float, default=0.3, help='вероятность опечатки в названии')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    correct_names, protocols = make_dataset(args.size, args.seed, args.per_protocol, args.noise)
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, 'correct_names.docx'), 'wb') as f:
+        f.write(correct_names_docx(correct_names))
+    for index, samples in enumerate(protocols, 1):
+        with open(os.path.join(args.output, f'protocol_{index:04d}.docx'), 'wb') as f:
+            f.write(protocol_docx(samples, seed=args.seed + index))
+    print(f"Записано протоколов: {len(protocols)}, образцов: {args.size}, каталог: {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""Пакетная обработка протоколов химического анализа без веб-интерфейса.
+
+    python cli.py протоколы/ --correct-names названия.docx --output отчет.docx
+    python cli.py --store образцы.sqlite3 --compact --keep-files 5000 --max-age-days 180
+
+Разбирает протоколы (каталоги, файлы или шаблоны путей), сопоставляет названия
+образцов, строит таблицы соответствия нормативам и сохраняет Word-отчёт и
+сводку в JSON, а с --export — все образцы в CSV, Parquet или Arrow. С --store
+разобранные протоколы сохраняются в SQLite и при повторной обработке не
+разбираются заново; --compact ограничивает размер хранилища. С --metrics время
+этапов и попадания в кэши записываются строками JSON. Streamlit не
+импортируется.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+from core import (
+    ChemicalAnalyzer,
+    Instrumentation,
+    ProtocolCache,
+    SampleExporter,
+    SampleStore,
+    build_word_report,
+    parse_protocol_files_parallel,
+    report_file_name,
+)
+
+logger = logging.getLogger('cli')
+
+
+def collect_protocol_paths(inputs, recursive=False, exclude=()):
+    """Пути к .docx по списку каталогов, файлов и шаблонов без повторов, в порядке перечисления.
+    Файлы из exclude (например, файл правильных названий в том же каталоге) пропускаются"""
+    paths = []
+    seen = {os.path.abspath(path) for path in exclude}
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, '**', '*.docx') if recursive else os.path.join(item, '*.docx')
+            found = sorted(glob.glob(pattern, recursive=recursive))
+        elif glob.has_magic(item):
+            found = sorted(glob.glob(item, recursive=True))
+        else:
+            found = [item]
+        for path in found:
+            # Временные файлы Word (~$имя.docx) не являются протоколами
+            if os.path.basename(path).startswith('~$'):
+                continue
+            key = os.path.abspath(path)
+            if key not in seen:
+                seen.add(key)
+                paths.append(path)
+    return paths
+
+
+def parse_protocols(analyzer, paths, workers=None, sequential=False, store=None):
+    """Список пар (образцы, ошибка) в порядке путей; сохранённые в store протоколы не разбираются"""
+    contents = []
+    results = [None] * len(paths)
+    for index, path in enumerate(paths):
+        try:
+            with open(path, 'rb') as f:
+                contents.append((index, f.read()))
+        except OSError as e:
+            results[index] = ([], str(e))
+
+    keys = {}
+    if store is not None:
+        keys = {index: ProtocolCache.content_key(content) for index, content in contents}
+        stored = store.get_many(keys.values(), diagnostics=analyzer.diagnostics)
+        for index, _ in contents:
+            if keys[index] in stored:
+                results[index] = ([dict(sample, composition=dict(sample['composition'])) for sample in stored[keys[index]]], None)
+        found = len(contents)
+        contents = [(index, content) for index, content in contents if results[index] is None]
+        analyzer.instrumentation.count('sample_store', hits=found - len(contents), misses=len(contents))
+        logger.info("Из хранилища загружено протоколов: %d", len(keys) - len(contents))
+
+    def report_progress(done, total):
+        logger.info("Разобрано протоколов: %d из %d", done, total)
+
+    if sequential or len(contents) < 2:
+        for done, (index, content) in enumerate(contents, 1):
+            try:
+                with analyzer.instrumentation.timed('parse_protocol_file', path=paths[index], bytes=len(content)):
+                    results[index] = (analyzer.parse_protocol_document(content), None)
+            except Exception as e:
+                results[index] = ([], str(e))
+            report_progress(done, len(contents))
+    else:
+        with analyzer.instrumentation.timed('parse_protocol_files_parallel', files=len(contents)):
+            parsed = parse_protocol_files_parallel(
+                [content for _, content in contents], max_workers=workers,
+                progress_callback=report_progress, diagnostics=analyzer.diagnostics
+            )
+        for (index, _), result in zip(contents, parsed):
+            results[index] = result
+        # Номера файлов в диагностике пула относятся к списку прочитанных файлов
+        for record in analyzer.diagnostics.records:
+            if record.get('file_index') is not None and 'path' not in record:
+                record['path'] = paths[contents[record['file_index']][0]]
+
+    if store is not None:
+        store.put_many(
+            [(keys[index], results[index][0]) for index, _ in contents if results[index][1] is None],
+            diagnostics=analyzer.diagnostics
+        )
+    return results
+
+
+def build_summary(paths, parse_results, samples, report_tables, report_path, messages):
+    matched = [s for s in samples if s.get('correct_number') is not None]
+    unmatched = [s for s in samples if s.get('correct_number') is None]
+    grades = {}
+    for grade, table_data in (report_tables or {}).items():
+        grades[grade] = {
+            'samples': len(table_data['samples']),
+            'with_deviations': int(table_data['deviations'].any(axis=1).sum())
+        }
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'report': report_path,
+        'protocol_files': [
+            {'path': path, 'samples': len(file_samples), 'error': error}
+            for path, (file_samples, error) in zip(paths, parse_results)
+        ],
+        'samples_total': len(samples),
+        'matched': len(matched),
+        'unmatched': [
+            {'name': s['original_name'], 'steel_grade': s.get('steel_grade')} for s in unmatched
+        ],
+        'matches': [
+            {
+                'original_name': s['original_name'],
+                'name': s['name'],
+                'correct_number': s['correct_number'],
+                'match_stage': s.get('match_stage'),
+                'steel_grade': s.get('steel_grade')
+            }
+            for s in sorted(matched, key=lambda s: s['correct_number'])
+        ],
+        'grades': grades,
+        'messages': messages
+    }
+
+
+def compact_store(args):
+    store = SampleStore(args.store)
+    before = store.stats()
+    removed = store.compact(max_files=args.keep_files, max_age_days=args.max_age_days)
+    after = store.stats()
+    logger.info(
+        "Хранилище %s: удалено протоколов %d, осталось %d (%d образцов), размер %.0f КБ → %.0f КБ",
+        args.store, removed, after['files'], after['samples'], before['bytes'] / 1024, after['bytes'] / 1024
+    )
+    return 0
+
+
+def run(args):
+    if args.compact:
+        return compact_store(args)
+
+    analyzer = ChemicalAnalyzer(instrumentation=Instrumentation(log_path=args.metrics))
+    analyzer.name_matcher.assignment = args.assignment
+    analyzer.name_matcher.assignment_workers = args.workers
+    store = SampleStore(args.store) if args.store else None
+
+    paths = collect_protocol_paths(args.protocols, recursive=args.recursive, exclude=[args.correct_names])
+    if not paths:
+        logger.error("Не найдено ни одного файла протокола")
+        return 2
+    logger.info("Найдено протоколов: %d", len(paths))
+
+    with open(args.correct_names, 'rb') as f:
+        correct_samples = analyzer.name_matcher.load_correct_names(f.read())
+    if not correct_samples:
+        logger.error("Не удалось загрузить правильные названия образцов из %s", args.correct_names)
+        return 2
+
+    parse_results = parse_protocols(analyzer, paths, workers=args.workers, sequential=args.sequential, store=store)
+    for path, (_, error) in zip(paths, parse_results):
+        if error:
+            analyzer.diagnostics.error(f"Ошибка при парсинге файла {path}: {error}", path=path)
+
+    all_samples = []
+    for file_samples, _ in parse_results:
+        all_samples.extend(file_samples)
+
+    samples = analyzer.match_sample_names(all_samples, correct_samples)
+    report_tables = analyzer.create_report_tables(samples)
+
+    report_path = None
+    if report_tables:
+        report_path = args.output or report_file_name()
+        with analyzer.instrumentation.timed('build_word_report', samples=len(samples)):
+            report = build_word_report(samples, report_tables)
+        with open(report_path, 'wb') as f:
+            f.write(report)
+        logger.info("Отчёт сохранён: %s", report_path)
+
+    for export_path in args.export or []:
+        SampleExporter(analyzer).write(samples, export_path)
+        logger.info("Образцы выгружены: %s", export_path)
+
+    summary = build_summary(paths, parse_results, samples, report_tables, report_path, analyzer.diagnostics.drain())
+    summary_path = args.summary or os.path.splitext(report_path or report_file_name())[0] + '.json'
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    logger.info("Сводка сохранена: %s", summary_path)
+
+    logger.info(
+        "Образцов: %d, сопоставлено: %d, не сопоставлено: %d",
+        summary['samples_total'], summary['matched'], len(summary['unmatched'])
+    )
+    analyzer.instrumentation.observe('name_features', analyzer.name_matcher.cache_stats())
+    analyzer.instrumentation.flush()
+    return 0 if report_tables else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Пакетная обработка протоколов химического анализа')
+    parser.add_argument('protocols', nargs='*', help='каталоги, файлы .docx или шаблоны путей')
+    parser.add_argument('--correct-names', help='файл .docx с правильными названиями образцов')
+    parser.add_argument('--output', help='путь к Word-отчёту (по умолчанию — имя с датой в текущем каталоге)')
+    parser.add_argument('--summary', help='путь к сводке JSON (по умолчанию — рядом с отчётом)')
+    parser.add_argument('--workers', type=int, default=None, help='число процессов для разбора протоколов')
+    parser.add_argument('--sequential', action='store_true', help='разбирать протоколы в одном процессе')
+    parser.add_argument('--recursive', action='store_true', help='искать протоколы во вложенных каталогах')
+    parser.add_argument('--assignment', choices=['greedy', 'global'], default='greedy',
+                        help='сопоставление по этапам (greedy) или глобальное назначение названий (global)')
+    parser.add_argument('--quiet', action='store_true', help='выводить только ошибки')
+    parser.add_argument('--export', action='append', metavar='PATH',
+                        help='выгрузить все образцы в .csv, .parquet или .arrow (можно указать несколько раз)')
+    parser.add_argument('--store', help='файл SQLite для хранения разобранных протоколов')
+    parser.add_argument('--metrics', help='дописывать замеры времени и кэшей в файл JSON Lines')
+    parser.add_argument('--compact', action='store_true',
+                        help='только сжать хранилище --store по --keep-files и --max-age-days')
+    parser.add_argument('--keep-files', type=int, default=None,
+                        help='сколько последних использованных протоколов оставить при сжатии')
+    parser.add_argument('--max-age-days', type=float, default=None,
+                        help='удалить протоколы, не использовавшиеся дольше указанного числа дней')
+    args = parser.parse_args(argv)
+
+    if args.compact:
+        if not args.store:
+            parser.error('для --compact нужен --store')
+    elif not args.protocols or not args.correct_names:
+        parser.error('нужны пути к протоколам и --correct-names')
+    for export_path in args.export or []:
+        if os.path.splitext(export_path)[1].lower() not in ('.csv', '.parquet', '.arrow', '.feather'):
+            parser.error(f'неизвестный формат выгрузки: {export_path}')
+
+    logging.basicConfig(
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format='%(levelname)s: %(message)s'
+    )
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
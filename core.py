@@ -0,0 +1,2761 @@
+"""Ядро анализа химического состава: разбор протоколов, сопоставление названий,
+таблицы соответствия нормативам и Word-отчёт. Модуль не зависит от Streamlit и
+используется как веб-интерфейсом (app.py), так и пакетной обработкой (cli.py).
+
+Ошибки и предупреждения не выводятся, а накапливаются в Diagnostics, откуда их
+забирает вызывающая сторона. python-docx и pandas импортируются при первом
+использовании, чтобы импорт модуля оставался быстрым для процессов разбора.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+import io
+import itertools
+import zipfile
+from lxml import etree
+import re
+import sqlite3
+import bisect
+import math
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from operator import itemgetter
+from xml.sax.saxutils import escape as xml_escape
+
+logger = logging.getLogger(__name__)
+
+_LOG_LEVELS = {'error': logging.ERROR, 'warning': logging.WARNING, 'info': logging.INFO}
+
+
+class Diagnostics:
+    """Сообщения ядра анализа для показа вызывающей стороной.
+
+    Каждая запись — словарь с ключами level ('error', 'warning' или 'info'),
+    message и необязательным контекстом (например, file_index).
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, level, message, **context):
+        record = {'level': level, 'message': message}
+        record.update(context)
+        self.records.append(record)
+        logger.log(_LOG_LEVELS.get(level, logging.INFO), message)
+        return record
+
+    def error(self, message, **context):
+        return self.add('error', message, **context)
+
+    def warning(self, message, **context):
+        return self.add('warning', message, **context)
+
+    def extend(self, records):
+        for record in records:
+            self.add(**record)
+
+    def drain(self):
+        """Возвращает накопленные записи и очищает список"""
+        records, self.records = self.records, []
+        return records
+
+    def __len__(self):
+        return len(self.records)
+
+
+class Instrumentation:
+    """Время и число вызовов участков обработки и попадания в кэши.
+
+    timed(name) суммирует время вызовов, count(name, hits, misses) — обращения
+    к кэшу, observe(name, stats) запоминает счётчики кэша, который ведёт их сам.
+    С log_path каждый замер и снимок кэшей дописываются в файл строкой JSON.
+    """
+
+    def __init__(self, log_path=None, session=None):
+        self.log_path = log_path
+        self.session = session
+        self.timings = {}
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, name, **context):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, **context)
+
+    def record(self, name, seconds, **context):
+        with self._lock:
+            entry = self.timings.get(name)
+            if entry is None:
+                entry = self.timings[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'last_seconds': 0.0}
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['last_seconds'] = seconds
+        self._write('timing', name=name, seconds=seconds, **context)
+
+    def count(self, name, hits=0, misses=0):
+        with self._lock:
+            entry = self.caches.setdefault(name, {'hits': 0, 'misses': 0})
+            entry['hits'] += hits
+            entry['misses'] += misses
+
+    def observe(self, name, stats):
+        """Счётчики кэша с собственной статистикой (ProtocolCache.stats, cache_stats сопоставителя)"""
+        with self._lock:
+            self.caches[name] = {'hits': stats['hits'], 'misses': stats['misses']}
+
+    def cache_rows(self):
+        # Счётчики пополняются и из фоновых потоков (IngestionJob): копия снимается под блокировкой
+        with self._lock:
+            caches = [(name, dict(entry)) for name, entry in self.caches.items()]
+        rows = []
+        for name, entry in sorted(caches):
+            total = entry['hits'] + entry['misses']
+            rows.append(dict(entry, name=name, hit_rate=entry['hits'] / total if total else 0.0))
+        return rows
+
+    def timing_rows(self):
+        with self._lock:
+            timings = [(name, dict(entry)) for name, entry in self.timings.items()]
+        return [
+            dict(entry, name=name, mean_seconds=entry['seconds'] / entry['calls'])
+            for name, entry in sorted(timings, key=lambda item: -item[1]['seconds'])
+        ]
+
+    def flush(self):
+        """Снимок счётчиков кэшей в журнал, например в конце прохода"""
+        for row in self.cache_rows():
+            self._write('cache', **row)
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.caches.clear()
+
+    def _write(self, event, **fields):
+        if not self.log_path:
+            return
+        line = json.dumps(
+            dict(time=datetime.now().isoformat(timespec='milliseconds'), session=self.session, event=event, **fields),
+            ensure_ascii=False, default=str
+        )
+        try:
+            with self._lock, open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            logger.warning("Не удалось записать замер в %s: %s", self.log_path, e)
+
+
+class SampleNameMatcher:
+    def __init__(self, diagnostics=None, instrumentation=None):
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.surface_types = {
+            'ЭПК': ['ЭПК'],
+            'ШПП': ['ШПП'],
+            'ПС КШ': ['ПС КШ', 'ПТ КШ', 'труба_ПТКМ', 'труба ПТКМ', 'ПТКМ', 'труба'],
+            'КПП ВД': ['КПП ВД', 'ВД'],
+            'КПП НД-1': ['КПП НД-1', 'КПП НД-I', 'НД-1', 'НД-I'],
+            'КПП НД-2': ['КПП НД-2', 'КПП НД-II', 'НД-2', 'НД-II', 'КПП НД-IIст', 'НД-IIст']
+        }
+        self.letters = ['А', 'Б', 'В', 'Г']
+        self.compile_surface_types()
+        self.similarity_threshold = 0.82
+        self.max_cached_names = 100000
+        self._feature_cache = {}
+        self._normalized_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.max_correct_sets = 8
+        self._correct_sets = OrderedDict()
+        # 'greedy' — этапы по очереди, 'global' — назначение по графу кандидатов (_match_globally)
+        self.assignment = 'greedy'
+        # Процессы для нечёткого поиска кандидатов при глобальном назначении, None — по числу ядер
+        self.assignment_workers = None
+
+    def load_correct_names(self, file_content):
+        """Правильные названия с признаками и индексами из реестра по хэшу содержимого файла.
+        Файл разбирается один раз; неудачный разбор не запоминается"""
+        key = hashlib.sha256(file_content).hexdigest()
+        correct_set = self._correct_sets.get(key)
+        if correct_set is not None:
+            self._correct_sets.move_to_end(key)
+            self.instrumentation.count('correct_names', hits=1)
+            return correct_set
+        self.instrumentation.count('correct_names', misses=1)
+        correct_set = CorrectNameSet(self.parse_correct_names(file_content), self, key=key)
+        if correct_set.samples:
+            self._correct_sets[key] = correct_set
+            while len(self._correct_sets) > self.max_correct_sets:
+                self._correct_sets.popitem(last=False)
+        return correct_set
+
+    def correct_name_set(self, correct_samples):
+        if isinstance(correct_samples, CorrectNameSet):
+            return correct_samples
+        return CorrectNameSet(correct_samples, self)
+
+    def parse_correct_names(self, file_content):
+        """Парсинг файла с правильными названиями образцов из таблицы"""
+        try:
+            from docx import Document
+
+            doc = Document(io.BytesIO(file_content))
+            correct_names = []
+
+            for table in doc.tables:
+                for row in table.rows:
+                    if len(row.cells) >= 2:
+                        number_cell = row.cells[0].text.strip()
+                        name_cell = row.cells[1].text.strip()
+                        if number_cell and name_cell and number_cell.isdigit():
+                            correct_names.append({
+                                'number': int(number_cell),
+                                'original': name_cell,
+                                'surface_type': self.extract_surface_type(name_cell),
+                                'tube_number': self.extract_tube_number_from_correct(name_cell),
+                                'letter': self.extract_letter(name_cell)
+                            })
+
+            if not correct_names:
+                for paragraph in doc.paragraphs:
+                    text = paragraph.text.strip()
+                    match = re.match(r'^\s*(\d+)\s+([^\s].*)$', text)
+                    if match:
+                        number = match.group(1)
+                        name = match.group(2).strip()
+                        if number.isdigit():
+                            correct_names.append({
+                                'number': int(number),
+                                'original': name,
+                                'surface_type': self.extract_surface_type(name),
+                                'tube_number': self.extract_tube_number_from_correct(name),
+                                'letter': self.extract_letter(name)
+                            })
+
+            correct_names.sort(key=lambda x: x['number'])
+            return correct_names
+        except Exception as e:
+            self.diagnostics.error(f"Ошибка при парсинге файла с правильными названиями: {str(e)}")
+            return []
+
+    def normalize_text(self, text):
+        if not text:
+            return ""
+        text = str(text).upper().strip()
+        text = text.replace('Ё', 'Е')
+        text = text.replace('№', ' ')
+        text = text.replace('_', ' ')
+        text = self.normalize_roman_numerals(text)
+        text = re.sub(r'ТРУБА', 'ТР', text)
+        text = re.sub(r'ТР\.', 'ТР ', text)
+        text = re.sub(r'[^А-ЯA-Z0-9]+', ' ', text)
+        text = re.sub(r'\s+', ' ', text).strip()
+        return text
+
+    def extract_tube_number_from_correct(self, correct_name):
+        """Извлечение номера трубы из правильного названия"""
+        normalized = self.normalize_text(correct_name)
+
+        patterns = [
+            r'\bТР\s*(\d+)\b',
+            r'\bТР\s*Н\s*(\d+)\b',
+            r'\((\d+)\)',
+        ]
+        for pattern in patterns:
+            match = re.search(pattern, normalized)
+            if match:
+                return match.group(1)
+
+        matches = re.findall(r'\b(\d+)\b', normalized)
+        if matches:
+            return matches[-1]
+        return None
+
+    def extract_surface_type(self, name):
+        """Извлечение типа поверхности нагрева из названия"""
+        return self.surface_type_recognizer.classify(self.normalize_text(name))
+
+    def compile_surface_types(self):
+        """Пересобирает распознаватель после изменения self.surface_types"""
+        patterns = []
+        for surface_type, type_patterns in self.surface_types.items():
+            for pattern in type_patterns:
+                patterns.append((self.normalize_text(pattern), surface_type))
+        self.surface_type_recognizer = SurfaceTypeRecognizer(patterns)
+
+    def normalize_roman_numerals(self, text):
+        """Нормализация римских цифр и суффиксов в тексте"""
+        replacements = [
+            ('НД-IIСТ', 'НД-2'),
+            ('НД-IСТ', 'НД-1'),
+            ('КПП НД-II', 'КПП НД-2'),
+            ('КПП НД-I', 'КПП НД-1'),
+            ('НД-II', 'НД-2'),
+            ('НД-I', 'НД-1'),
+            ('IIСТ', '2'),
+            ('IСТ', '1'),
+            ('III', '3'),
+            ('II', '2'),
+            ('I', '1'),
+        ]
+        result = str(text)
+        for roman, arabic in replacements:
+            result = result.replace(roman, arabic)
+        return result
+
+    def similar(self, a, b):
+        return SequenceMatcher(None, a, b).ratio()
+
+    def extract_letter(self, name):
+        normalized = self.normalize_text(name)
+        patterns = [
+            r'\bН\s*([А-ГA-D])\b',
+            r'\b([А-ГA-D])\b',
+        ]
+        for pattern in patterns:
+            matches = re.findall(pattern, normalized)
+            if matches:
+                letter = matches[0]
+                latin_to_cyr = {'A': 'А', 'B': 'Б', 'C': 'В', 'D': 'Г'}
+                return latin_to_cyr.get(letter, letter)
+        return None
+
+    def extract_tube_number_from_protocol(self, sample_name):
+        normalized = self.normalize_text(sample_name)
+        patterns = [
+            r'\bТР\s*Н?\s*(\d+)\b',
+            r'\((\d+)\)',
+        ]
+        for pattern in patterns:
+            match = re.search(pattern, normalized)
+            if match:
+                return match.group(1)
+
+        numbers = re.findall(r'\b\d+\b', normalized)
+        if numbers:
+            return max(numbers, key=lambda x: int(x))
+        return None
+
+    def parse_protocol_sample_name(self, sample_name):
+        """Признаки названия из протокола, разбираются один раз на уникальную строку.
+
+        Возвращаемый словарь общий для всех вызывающих и не должен изменяться.
+        """
+        features = self._feature_cache.get(sample_name)
+        if features is not None:
+            self.cache_hits += 1
+            return features
+        self.cache_misses += 1
+        features = self._extract_protocol_features(sample_name)
+        if len(self._feature_cache) >= self.max_cached_names:
+            self._feature_cache.clear()
+        self._feature_cache[sample_name] = features
+        return features
+
+    def normalized_name(self, name):
+        """Кэшированный результат normalize_text для сопоставления по сходству"""
+        normalized = self._normalized_cache.get(name)
+        if normalized is not None:
+            self.cache_hits += 1
+            return normalized
+        self.cache_misses += 1
+        normalized = self.normalize_text(name)
+        if len(self._normalized_cache) >= self.max_cached_names:
+            self._normalized_cache.clear()
+        self._normalized_cache[name] = normalized
+        return normalized
+
+    def cache_stats(self):
+        total = self.cache_hits + self.cache_misses
+        return {
+            'names': len(self._feature_cache),
+            'normalized': len(self._normalized_cache),
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': self.cache_hits / total if total else 0.0
+        }
+
+    def _extract_protocol_features(self, sample_name):
+        original_name = sample_name
+        normalized = self.normalize_text(sample_name)
+
+        letter = None
+        letter_map = {'НА': 'А', 'НБ': 'Б', 'НВ': 'В', 'НГ': 'Г'}
+        compact = normalized.replace(' ', '')
+        for prefix, mapped_letter in letter_map.items():
+            if prefix in compact:
+                letter = mapped_letter
+                break
+
+        if not letter:
+            patterns = [
+                r'Н\s*([А-ГA-D])',
+            ]
+            for pattern in patterns:
+                matches = re.findall(pattern, normalized)
+                if matches:
+                    value = matches[0]
+                    latin_to_cyr = {'A': 'А', 'B': 'Б', 'C': 'В', 'D': 'Г'}
+                    letter = latin_to_cyr.get(value, value)
+                    break
+
+        tube_number = self.extract_tube_number_from_protocol(sample_name)
+        surface_type = self.surface_type_recognizer.classify(normalized)
+
+        return {
+            'original': original_name,
+            'normalized': normalized,
+            'surface_type': surface_type,
+            'tube_number': tube_number,
+            'letter': letter
+        }
+
+    def match_stages(self):
+        """Этапы сопоставления по порядку: (имя, метод(образцы, CorrectNameSet, занятые названия))"""
+        return [
+            ('tube_type_letter', self._match_by_tube_type_and_letter),
+            ('tube_type', self._match_by_tube_and_type),
+            ('tube', self._match_by_tube_only),
+            ('similarity', self._match_by_similarity),
+        ]
+
+    def match_samples(self, protocol_samples, correct_samples):
+        """Многоэтапное сопоставление образцов"""
+        correct_set = self.correct_name_set(correct_samples)
+        if self.assignment == 'global':
+            with self.instrumentation.timed('match.global', samples=len(protocol_samples)):
+                return self._match_globally(protocol_samples, correct_set)
+        matched_samples = []
+        unmatched_protocol = list(protocol_samples)
+        used_correct = set()
+
+        for name, stage in self.match_stages():
+            with self.instrumentation.timed(f'match.{name}', samples=len(unmatched_protocol)):
+                stage_matches = stage(unmatched_protocol, correct_set, used_correct)
+            matched_samples.extend(stage_matches)
+            matched_ids = {id(match[0]) for match in stage_matches}
+            unmatched_protocol = [s for s in unmatched_protocol if id(s) not in matched_ids]
+
+        return matched_samples, unmatched_protocol
+
+    # Подсказки для ручного выбора: (ключ точного этапа, пояснение) по убыванию приоритета
+    SUGGESTION_KEYS = (
+        ('tube_type_letter', 'труба, тип и нитка'),
+        ('tube_type', 'труба и тип'),
+        ('tube', 'труба'),
+    )
+
+    def suggest(self, sample_name, correct_samples, limit=10):
+        """До limit троек (правильное название, сходство, пояснение) для ручного выбора.
+
+        Первыми идут названия, совпадающие по ключам точных этапов, затем
+        наиболее похожие по нормализованному названию. Результат запоминается
+        в CorrectNameSet, поэтому при перезапусках не пересчитывается.
+        """
+        correct_set = self.correct_name_set(correct_samples)
+        cache_key = (sample_name, limit)
+        cached = correct_set.suggestion_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        info = self.parse_protocol_sample_name(sample_name)
+        key_funcs = {'tube_type_letter': self._key_tube_type_letter, 'tube_type': self._key_tube_type, 'tube': self._key_tube}
+        ranked = {}
+        for priority, (index_name, reason) in enumerate(self.SUGGESTION_KEYS):
+            key = key_funcs[index_name](info)
+            for correct in correct_set.indexes[index_name].get(key, ()) if key is not None else ():
+                # Для совпадения только по трубе нитки не должны противоречить друг другу
+                if index_name == 'tube' and info['letter'] and correct['letter'] and info['letter'] != correct['letter']:
+                    continue
+                ranked.setdefault(correct_set.positions[correct['original']], (priority, reason))
+        fuzzy_index = correct_set.fuzzy_index
+        scores = dict(fuzzy_index.ranked(info['normalized'], limit))
+        for position in ranked:
+            if position not in scores:
+                scores[position] = fuzzy_index.ratio(info['normalized'], position)
+        for position in scores:
+            ranked.setdefault(position, (len(self.SUGGESTION_KEYS), 'сходство названий'))
+
+        order = sorted(ranked, key=lambda position: (ranked[position][0], -scores[position], position))
+        suggestions = [(correct_set[position], scores[position], ranked[position][1]) for position in order[:limit]]
+        if len(correct_set.suggestion_cache) >= self.max_cached_names:
+            correct_set.suggestion_cache.clear()
+        correct_set.suggestion_cache[cache_key] = suggestions
+        return suggestions
+
+    def search_correct_names(self, query, correct_samples, limit=50):
+        """Правильные названия, содержащие query без учёта регистра и написания, не больше limit"""
+        correct_set = self.correct_name_set(correct_samples)
+        normalized = self.normalize_text(query)
+        lowered = str(query).strip().lower()
+        if not normalized and not lowered:
+            return []
+        found = []
+        for name, name_normalized in zip(correct_set.options, correct_set.normalized):
+            if (normalized and normalized in name_normalized) or (lowered and lowered in name.lower()):
+                found.append(name)
+                if len(found) >= limit:
+                    break
+        return found
+
+    # Веса рёбер глобального назначения: разница между этапами больше вклада сходства названий
+    ASSIGNMENT_WEIGHTS = {'tube_type_letter': 4.0, 'tube_type': 3.0, 'tube': 2.0, 'similarity': 1.0}
+    ASSIGNMENT_SIMILARITY_WEIGHT = 0.5
+    ASSIGNMENT_REASONS = {
+        'tube_type_letter': 'совпадение по трубе, типу и нитке',
+        'tube_type': 'совпадение по трубе и типу',
+        'tube': 'совпадение по трубе',
+    }
+
+    def assignment_edges(self, protocol_samples, correct_set, fuzzy_limit=3):
+        """Рёбра графа кандидатов {(номер образца, позиция названия): (вес, этап, сходство)}.
+
+        Образец связан с названиями только первого по порядку точного этапа,
+        у которого для него есть кандидаты, а если таких нет — с fuzzy_limit
+        самыми похожими названиями не ниже similarity_threshold. Так граф
+        остаётся разреженным и распадается на небольшие компоненты.
+        """
+        fuzzy_index = correct_set.fuzzy_index
+        key_funcs = (
+            ('tube_type_letter', self._key_tube_type_letter),
+            ('tube_type', self._key_tube_type),
+            ('tube', self._key_tube),
+        )
+        edges = {}
+        fuzzy_samples = []
+        for sample_index, protocol in enumerate(protocol_samples):
+            info = self.parse_protocol_sample_name(protocol['name'])
+            linked = False
+            for index_name, key_func in key_funcs:
+                key = key_func(info)
+                if key is None:
+                    continue
+                for correct in correct_set.indexes[index_name].get(key, ()):
+                    if index_name == 'tube' and info['letter'] and correct['letter'] and info['letter'] != correct['letter']:
+                        continue
+                    edge = (sample_index, correct_set.positions[correct['original']])
+                    if edge in edges:
+                        continue
+                    score = fuzzy_index.ratio(info['normalized'], edge[1])
+                    weight = self.ASSIGNMENT_WEIGHTS[index_name] + self.ASSIGNMENT_SIMILARITY_WEIGHT * score
+                    edges[edge] = (weight, index_name, score)
+                    linked = True
+                if linked:
+                    break
+            if not linked:
+                fuzzy_samples.append((sample_index, info['normalized']))
+
+        texts = [text for _, text in fuzzy_samples]
+        if len(texts) >= 500 and (self.assignment_workers or os.cpu_count() or 1) > 1:
+            found = fuzzy_matches_parallel(
+                correct_set.normalized, texts, self.similarity_threshold, fuzzy_limit, self.assignment_workers
+            )
+        else:
+            found = [fuzzy_index.matches(text, self.similarity_threshold, fuzzy_limit) for text in texts]
+        for (sample_index, _), matches in zip(fuzzy_samples, found):
+            for position, score in matches:
+                weight = self.ASSIGNMENT_WEIGHTS['similarity'] + self.ASSIGNMENT_SIMILARITY_WEIGHT * score
+                edges[(sample_index, position)] = (weight, 'similarity', score)
+        return edges
+
+    def _match_globally(self, protocol_samples, correct_set, max_component=2000):
+        """Назначение наибольшего суммарного веса отдельно для каждой связной компоненты
+        графа кандидатов; в компонентах больше max_component образцов рёбра выбираются
+        жадно по убыванию веса. Оставшиеся образцы проходят обычные этапы по свободным названиям"""
+        import numpy as np
+
+        protocol_samples = list(protocol_samples)
+        edges = self.assignment_edges(protocol_samples, correct_set)
+
+        # Компоненты связности: вершины-образцы (i, 0) и вершины-названия (позиция, 1)
+        parent = {}
+
+        def find(node):
+            root = node
+            while parent.setdefault(root, root) != root:
+                root = parent[root]
+            while parent[node] != root:
+                parent[node], node = root, parent[node]
+            return root
+
+        for sample_index, position in edges:
+            parent[find((sample_index, 0))] = find((position, 1))
+        components = {}
+        for sample_index, position in edges:
+            components.setdefault(find((sample_index, 0)), []).append((sample_index, position))
+
+        assigned = {}
+        for component_edges in components.values():
+            rows = sorted({edge[0] for edge in component_edges})
+            columns = sorted({edge[1] for edge in component_edges})
+            if min(len(rows), len(columns)) > max_component:
+                taken = set()
+                for edge in sorted(component_edges, key=lambda edge: (-edges[edge][0], edge)):
+                    if edge[0] not in assigned and edge[1] not in taken:
+                        assigned[edge[0]] = edge[1]
+                        taken.add(edge[1])
+                continue
+            weights = np.zeros((len(rows), len(columns)))
+            row_of = {sample_index: k for k, sample_index in enumerate(rows)}
+            column_of = {position: k for k, position in enumerate(columns)}
+            for edge in component_edges:
+                weights[row_of[edge[0]], column_of[edge[1]]] = edges[edge][0]
+            for row, column in max_weight_assignment(weights):
+                assigned[rows[row]] = columns[column]
+
+        matched_samples = []
+        used_correct = set()
+        for sample_index, position in sorted(assigned.items()):
+            _, stage, score = edges[(sample_index, position)]
+            correct = correct_set[position]
+            if stage == 'similarity':
+                reason = f'нечёткое совпадение по названию ({score:.2f})'
+            else:
+                reason = self.ASSIGNMENT_REASONS[stage]
+            matched_samples.append((protocol_samples[sample_index], correct, reason))
+            used_correct.add(correct['original'])
+
+        unmatched_protocol = [sample for k, sample in enumerate(protocol_samples) if k not in assigned]
+        for _, stage in self.match_stages():
+            stage_matches = stage(unmatched_protocol, correct_set, used_correct)
+            matched_samples.extend(stage_matches)
+            matched_ids = {id(match[0]) for match in stage_matches}
+            unmatched_protocol = [s for s in unmatched_protocol if id(s) not in matched_ids]
+        return matched_samples, unmatched_protocol
+
+    @staticmethod
+    def _index_correct(correct_samples, key_func):
+        """Индекс правильных названий по ключу с сохранением исходного порядка"""
+        index = {}
+        for correct in correct_samples:
+            key = key_func(correct)
+            if key is not None:
+                index.setdefault(key, []).append(correct)
+        return index
+
+    # Ключи точных этапов: одинаково вычисляются по признакам правильного названия и названия из протокола
+    @staticmethod
+    def _key_tube_type_letter(info):
+        if info['tube_number'] and info['surface_type'] and info['letter']:
+            return info['tube_number'], info['surface_type'], info['letter']
+        return None
+
+    @staticmethod
+    def _key_tube_type(info):
+        if info['tube_number'] and info['surface_type']:
+            return info['tube_number'], info['surface_type']
+        return None
+
+    @staticmethod
+    def _key_tube(info):
+        return info['tube_number'] or None
+
+    @staticmethod
+    def _first_available(candidates, used_correct, accept=None):
+        """Первый неиспользованный кандидат; использованные удаляются из списка"""
+        i = 0
+        while i < len(candidates):
+            correct = candidates[i]
+            if correct['original'] in used_correct:
+                del candidates[i]
+                continue
+            if accept is None or accept(correct):
+                return correct
+            i += 1
+        return None
+
+    def _match_by_tube_type_and_letter(self, protocol_samples, correct_set, used_correct):
+        index = correct_set.working_index('tube_type_letter')
+        matches = []
+        for protocol in protocol_samples:
+            protocol_key = self._key_tube_type_letter(self.parse_protocol_sample_name(protocol['name']))
+            if protocol_key not in index:
+                continue
+            correct = self._first_available(index[protocol_key], used_correct)
+            if correct is not None:
+                matches.append((protocol, correct, 'совпадение по трубе, типу и нитке'))
+                used_correct.add(correct['original'])
+        return matches
+
+    def _match_by_tube_and_type(self, protocol_samples, correct_set, used_correct):
+        index = correct_set.working_index('tube_type')
+        matches = []
+        for protocol in protocol_samples:
+            protocol_key = self._key_tube_type(self.parse_protocol_sample_name(protocol['name']))
+            if protocol_key not in index:
+                continue
+            correct = self._first_available(index[protocol_key], used_correct)
+            if correct is not None:
+                matches.append((protocol, correct, 'совпадение по трубе и типу'))
+                used_correct.add(correct['original'])
+        return matches
+
+    def _match_by_tube_only(self, protocol_samples, correct_set, used_correct):
+        index = correct_set.working_index('tube')
+        matches = []
+        for protocol in protocol_samples:
+            protocol_info = self.parse_protocol_sample_name(protocol['name'])
+            if not protocol_info['tube_number'] or protocol_info['tube_number'] not in index:
+                continue
+            letter = protocol_info['letter']
+            correct = self._first_available(
+                index[protocol_info['tube_number']], used_correct,
+                lambda c: not (letter and c['letter'] and letter != c['letter'])
+            )
+            if correct is not None:
+                matches.append((protocol, correct, 'совпадение по трубе'))
+                used_correct.add(correct['original'])
+        return matches
+
+    def _match_by_similarity(self, protocol_samples, correct_set, used_correct):
+        fuzzy_index = correct_set.fuzzy_index
+        correct_samples = correct_set.samples
+        matches = []
+        for protocol in protocol_samples:
+            protocol_norm = self.parse_protocol_sample_name(protocol['name'])['normalized']
+            position, best_score = fuzzy_index.best_match(
+                protocol_norm, self.similarity_threshold,
+                lambda i: correct_samples[i]['original'] not in used_correct
+            )
+            if position is not None:
+                best = correct_samples[position]
+                matches.append((protocol, best, f'нечёткое совпадение по названию ({best_score:.2f})'))
+                used_correct.add(best['original'])
+        return matches
+
+
+class CorrectNameSet:
+    """Правильные названия образцов вместе с индексами для сопоставления.
+
+    Строится один раз на файл (SampleNameMatcher.load_correct_names) и
+    используется всеми этапами сопоставления, ручным сопоставлением и списком
+    выбора. Индексы не изменяются: этапы работают с их копиями.
+    """
+
+    def __init__(self, samples, matcher, key=None):
+        self.key = key
+        self.samples = samples
+        self.options = [correct['original'] for correct in samples]
+        self.positions = {}
+        for position, name in enumerate(self.options):
+            self.positions.setdefault(name, position)
+        self.normalized = [matcher.normalized_name(name) for name in self.options]
+        self.indexes = {
+            'tube_type_letter': matcher._index_correct(samples, matcher._key_tube_type_letter),
+            'tube_type': matcher._index_correct(samples, matcher._key_tube_type),
+            'tube': matcher._index_correct(samples, matcher._key_tube),
+        }
+        self._fuzzy_index = None
+        # Подсказки для ручного сопоставления по (название образца, число подсказок)
+        self.suggestion_cache = {}
+
+    @property
+    def fuzzy_index(self):
+        # Нужен только когда после точных этапов остались образцы
+        if self._fuzzy_index is None:
+            self._fuzzy_index = FuzzyNameIndex(self.normalized)
+        return self._fuzzy_index
+
+    def working_index(self, name):
+        """Копия индекса точного этапа, из которой можно удалять занятые названия"""
+        return {key: list(candidates) for key, candidates in self.indexes[name].items()}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __iter__(self):
+        return iter(self.samples)
+
+    def __getitem__(self, position):
+        return self.samples[position]
+
+
+class SurfaceTypeRecognizer:
+    """Автомат Ахо — Корасик по нормализованным шаблонам типов поверхностей.
+
+    За один проход по названию находит все входящие в него шаблоны и
+    возвращает тип шаблона с наивысшим приоритетом (порядок в списке), как и
+    последовательная проверка подстрок. Если ни один шаблон не входит в
+    название, выполняется нечёткое сравнение с порогом 0.7, но только для
+    шаблонов, прошедших оценку по длинам и составу символов.
+    """
+
+    similarity_threshold = 0.7
+
+    def __init__(self, patterns):
+        self.patterns = []
+        seen = set()
+        for pattern, surface_type in patterns:
+            if pattern and pattern not in seen:
+                seen.add(pattern)
+                self.patterns.append((pattern, surface_type))
+
+        self._goto = [{}]
+        self._fail = [0]
+        # Наивысший приоритет (наименьший индекс шаблона) среди шаблонов, оканчивающихся в состоянии
+        self._output = [None]
+        for priority, (pattern, _) in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                state = next_state
+            if self._output[state] is None:
+                self._output[state] = priority
+
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                inherited = self._output[fail]
+                if inherited is not None and (self._output[next_state] is None or inherited < self._output[next_state]):
+                    self._output[next_state] = inherited
+
+    def find_priority(self, text):
+        """Наименьший индекс шаблона, входящего в text, или None"""
+        best = None
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            priority = self._output[state]
+            if priority is not None and (best is None or priority < best):
+                best = priority
+                if best == 0:
+                    break
+        return best
+
+    def classify(self, normalized_name):
+        priority = self.find_priority(normalized_name)
+        if priority is not None:
+            return self.patterns[priority][1]
+
+        name_length = len(normalized_name)
+        matcher = None
+        for pattern, surface_type in self.patterns:
+            # То же, что real_quick_ratio(): верхняя оценка ratio только по длинам строк
+            if 2.0 * min(len(pattern), name_length) / (len(pattern) + name_length) <= self.similarity_threshold:
+                continue
+            if matcher is None:
+                matcher = SequenceMatcher(None, '', normalized_name)
+            matcher.set_seq1(pattern)
+            if matcher.quick_ratio() > self.similarity_threshold and matcher.ratio() > self.similarity_threshold:
+                return surface_type
+        return None
+
+
+class FuzzyNameIndex:
+    """Нечёткий поиск по нормализованным названиям с отсечением кандидатов.
+
+    Названия индексируются по символьным биграммам с маркерами границ строки.
+    Совпадающие блоки SequenceMatcher дают не меньше 3·M − T − 1 общих биграмм
+    (с учётом кратности), отсюда нижняя граница числа общих биграмм для порога;
+    при пороге выше 0.8 названия без общих биграмм не рассматриваются вовсе.
+    Кандидаты проверяются по убыванию числа общих биграмм, затем отсекаются по
+    real_quick_ratio/quick_ratio, и только после этого считается полный ratio().
+    Результат совпадает с полным перебором: лучшее название с ratio не ниже
+    порога, при равенстве — стоящее раньше в списке.
+    """
+
+    ngram_size = 2
+    max_unshared_ratio = 0.8
+
+    def __init__(self, names):
+        self.names = list(names)
+        self._lengths = [len(name) for name in self.names]
+        self.postings = {}
+        for position, name in enumerate(self.names):
+            for token in self.tokens(name):
+                self.postings.setdefault(token, []).append(position)
+        self._matchers = {}
+
+    @classmethod
+    def tokens(cls, text):
+        """Биграммы строки с номером вхождения, чтобы учитывать кратность"""
+        padded = '\x02' + text + '\x03'
+        counts = {}
+        tokens = []
+        for i in range(len(padded) - cls.ngram_size + 1):
+            gram = padded[i:i + cls.ngram_size]
+            counts[gram] = counts.get(gram, 0) + 1
+            tokens.append((gram, counts[gram]))
+        return tokens
+
+    def candidates(self, text, min_shared=1):
+        """Пары (позиция, число общих биграмм) по убыванию числа общих биграмм"""
+        shared = Counter()
+        for token in self.tokens(text):
+            shared.update(self.postings.get(token, ()))
+        return sorted(
+            (item for item in shared.items() if item[1] >= min_shared),
+            key=itemgetter(1), reverse=True
+        )
+
+    @staticmethod
+    def min_shared(floor, total):
+        """Минимум общих биграмм для ratio >= floor: shared >= 3·M − T − 1 и M >= floor·T / 2"""
+        # Небольшой запас на погрешность вычислений с плавающей точкой
+        return (1.5 * floor - 1) * total - 1 - 1e-9
+
+    def _matcher(self, position):
+        # SequenceMatcher кэширует разбор второй строки, поэтому он создаётся один раз на название
+        matcher = self._matchers.get(position)
+        if matcher is None:
+            matcher = SequenceMatcher(None, '', self.names[position])
+            self._matchers[position] = matcher
+        return matcher
+
+    def ratio(self, text, position):
+        matcher = self._matcher(position)
+        matcher.set_seq1(text)
+        return matcher.ratio()
+
+    def ranked(self, text, limit, max_candidates=200):
+        """До limit пар (позиция, ratio) по убыванию ratio среди max_candidates названий
+        с наибольшим числом общих биграмм"""
+        scored = [
+            (position, self.ratio(text, position))
+            for position, _ in self.candidates(text)[:max_candidates]
+        ]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
+
+    def matches(self, text, threshold, limit):
+        """До limit пар (позиция, ratio) с ratio не ниже threshold по убыванию ratio"""
+        if threshold <= self.max_unshared_ratio:
+            raise ValueError(f"Порог {threshold} слишком низкий для биграммного отбора (нужно > {self.max_unshared_ratio})")
+        text_length = len(text)
+        required = self.min_shared(threshold, text_length * (1 + threshold / (2 - threshold)))
+        found = []
+        floor = threshold
+        for position, shared in self.candidates(text, max(1, math.ceil(required))):
+            if shared < required:
+                break
+            if shared < self.min_shared(floor, text_length + self._lengths[position]):
+                continue
+            matcher = self._matcher(position)
+            matcher.set_seq1(text)
+            if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
+                continue
+            score = matcher.ratio()
+            if score < floor:
+                continue
+            found.append((position, score))
+            if len(found) >= limit:
+                # Дальше нужны только названия не хуже худшего из limit лучших
+                found.sort(key=lambda item: (-item[1], item[0]))
+                del found[limit:]
+                floor = found[-1][1]
+                required = self.min_shared(floor, text_length * (1 + floor / (2 - floor)))
+        found.sort(key=lambda item: (-item[1], item[0]))
+        return found[:limit]
+
+    def best_match(self, text, threshold, is_available=None):
+        """Позиция и оценка лучшего названия с ratio не ниже threshold или (None, 0).
+
+        Кандидаты перебираются по убыванию числа общих биграмм; перебор
+        прекращается, когда у оставшихся их слишком мало, чтобы превзойти
+        лучший найденный ratio.
+        """
+        if threshold <= self.max_unshared_ratio:
+            raise ValueError(f"Порог {threshold} слишком низкий для биграммного отбора (нужно > {self.max_unshared_ratio})")
+        text_length = len(text)
+        # real_quick_ratio отсекает названия короче text_length·floor / (2 − floor)
+        required = self.min_shared(threshold, text_length * (1 + threshold / (2 - threshold)))
+        best = None
+        best_score = 0
+        floor = threshold
+        for position, shared in self.candidates(text, max(1, math.ceil(required))):
+            if shared < required:
+                break
+            if shared < self.min_shared(floor, text_length + self._lengths[position]):
+                continue
+            if is_available is not None and not is_available(position):
+                continue
+            matcher = self._matcher(position)
+            matcher.set_seq1(text)
+            if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
+                continue
+            score = matcher.ratio()
+            if score < threshold:
+                continue
+            # При равной оценке выигрывает название, стоящее раньше в списке
+            if score > best_score or (score == best_score and position < best):
+                best_score = score
+                best = position
+                floor = best_score
+                required = self.min_shared(floor, text_length * (1 + floor / (2 - floor)))
+        return best, best_score
+
+
+def max_weight_assignment(weights):
+    """Пары (строка, столбец) с наибольшей суммой весов, каждая строка и каждый столбец
+    не больше чем в одной паре. weights — матрица numpy, 0 — ребра нет, веса положительны.
+
+    Венгерский алгоритм с потенциалами (O(n²·m) для n ≤ m) на матрице стоимостей
+    −weights: пара с нулевой стоимостью означает, что строка остаётся без пары.
+    """
+    import numpy as np
+
+    if weights.size == 0:
+        return []
+    if weights.shape[0] == 1 or weights.shape[1] == 1:
+        # Одна строка или один столбец: достаточно наибольшего веса
+        row, column = np.unravel_index(int(np.argmax(weights)), weights.shape)
+        return [(int(row), int(column))] if weights[row, column] > 0 else []
+
+    transposed = weights.shape[0] > weights.shape[1]
+    cost = -(weights.T if transposed else weights)
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    # owner[j] — строка (с единицы), назначенная столбцу j; столбец 0 — вспомогательный
+    owner = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for row in range(1, n + 1):
+        owner[0] = row
+        column = 0
+        min_reduced = np.full(m + 1, np.inf)
+        visited = np.zeros(m + 1, dtype=bool)
+        while True:
+            visited[column] = True
+            current_row = owner[column]
+            reduced = cost[current_row - 1] - u[current_row] - v[1:]
+            free = ~visited[1:]
+            better = free & (reduced < min_reduced[1:])
+            min_reduced[1:][better] = reduced[better]
+            way[1:][better] = column
+            candidates = np.where(free, min_reduced[1:], np.inf)
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+            visited_columns = np.flatnonzero(visited)
+            u[owner[visited_columns]] += delta
+            v[visited_columns] -= delta
+            min_reduced[1:][free] -= delta
+            column = next_column
+            if owner[column] == 0:
+                break
+        while column:
+            previous = way[column]
+            owner[column] = owner[previous]
+            column = previous
+
+    pairs = []
+    for column in range(1, m + 1):
+        if owner[column]:
+            row = owner[column] - 1
+            pair = (column - 1, row) if transposed else (row, column - 1)
+            if weights[pair] > 0:
+                pairs.append(pair)
+    return sorted(pairs)
+
+
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_BODY = _W_NS + 'body'
+_W_P = _W_NS + 'p'
+_W_R = _W_NS + 'r'
+_W_TBL = _W_NS + 'tbl'
+_W_TR = _W_NS + 'tr'
+_W_TC = _W_NS + 'tc'
+_PROTOCOL_TABLE_ROWS = (0, 5, 7, 12)
+
+
+class _UnexpectedLayout(Exception):
+    pass
+
+
+def _xml_run_text(run):
+    parts = []
+    for child in run:
+        tag = child.tag
+        if tag == _W_NS + 't':
+            parts.append(child.text or '')
+        elif tag in (_W_NS + 'tab', _W_NS + 'ptab'):
+            parts.append('\t')
+        elif tag == _W_NS + 'br':
+            if child.get(_W_NS + 'type', 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        elif tag == _W_NS + 'cr':
+            parts.append('\n')
+        elif tag == _W_NS + 'noBreakHyphen':
+            parts.append('-')
+    return ''.join(parts)
+
+
+def _xml_paragraph_text(paragraph):
+    """Текст абзаца по тем же правилам, что и Paragraph.text в python-docx"""
+    parts = []
+    for child in paragraph:
+        if child.tag == _W_R:
+            parts.append(_xml_run_text(child))
+        elif child.tag == _W_NS + 'hyperlink':
+            parts.extend(_xml_run_text(run) for run in child.iterchildren(_W_R))
+    return ''.join(parts)
+
+
+def _xml_row_cells(row):
+    cells = []
+    for tc in row.iterchildren(_W_TC):
+        tc_pr = tc.find(_W_NS + 'tcPr')
+        span = 1
+        if tc_pr is not None:
+            v_merge = tc_pr.find(_W_NS + 'vMerge')
+            if v_merge is not None and v_merge.get(_W_NS + 'val', 'continue') == 'continue':
+                raise _UnexpectedLayout()
+            grid_span = tc_pr.find(_W_NS + 'gridSpan')
+            if grid_span is not None:
+                span = int(grid_span.get(_W_NS + 'val', '1'))
+        text = '\n'.join(_xml_paragraph_text(p) for p in tc.iterchildren(_W_P)).strip()
+        cells.extend([text] * span)
+    return cells
+
+
+def _xml_row_label(row):
+    """Текст первой ячейки строки; _UnexpectedLayout, если она продолжает объединение по вертикали"""
+    tc = row.find(_W_TC)
+    if tc is None:
+        return ''
+    tc_pr = tc.find(_W_NS + 'tcPr')
+    if tc_pr is not None:
+        v_merge = tc_pr.find(_W_NS + 'vMerge')
+        if v_merge is not None and v_merge.get(_W_NS + 'val', 'continue') == 'continue':
+            raise _UnexpectedLayout()
+    return '\n'.join(_xml_paragraph_text(p) for p in tc.iterchildren(_W_P)).strip()
+
+
+def _scan_protocol_xml(stream):
+    """Один потоковый проход по document.xml.
+
+    Возвращает непустые абзацы верхнего уровня и для каждой таблицы верхнего
+    уровня тройку (число строк, {индекс: ячейки} только для строк 0/5/7/12,
+    подписи первого столбца всех строк).
+    """
+    paragraphs = []
+    tables = []
+    row_index = 0
+    rows = {}
+    labels = []
+    for event, elem in etree.iterparse(stream, events=('start', 'end'), tag=(_W_P, _W_TBL, _W_TR)):
+        parent = elem.getparent()
+        if elem.tag == _W_TBL:
+            if parent is None or parent.tag != _W_BODY:
+                continue
+            if event == 'start':
+                row_index = 0
+                rows = {}
+                labels = []
+                continue
+            tables.append((row_index, rows, labels))
+        elif event == 'start':
+            continue
+        elif elem.tag == _W_P:
+            if parent is None or parent.tag != _W_BODY:
+                continue
+            text = _xml_paragraph_text(elem).strip()
+            if text:
+                paragraphs.append(text)
+        else:
+            grandparent = parent.getparent() if parent is not None else None
+            if grandparent is None or grandparent.tag != _W_BODY:
+                continue
+            if row_index in _PROTOCOL_TABLE_ROWS:
+                cells = rows[row_index] = _xml_row_cells(elem)
+                labels.append(cells[0] if cells else '')
+            else:
+                try:
+                    labels.append(_xml_row_label(elem))
+                except _UnexpectedLayout:
+                    # Продолжение объединения по вертикали: как в python-docx, текст первой ячейки объединения
+                    labels.append(labels[-1] if labels else '')
+            row_index += 1
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+    return paragraphs, tables
+
+
+ALL_ELEMENTS = ["C", "Si", "Mn", "P", "S", "Cr", "Mo", "Ni",
+                "Cu", "Al", "Co", "Nb", "Ti", "V", "W", "Fe"]
+
+# Очистка текста значения: десятичная запятая и пробелы между разрядами
+_VALUE_CLEANUP = str.maketrans({',': '.', ' ': None})
+
+
+def parse_composition_values(pairs):
+    """Состав из пар (элемент, текст ячейки). Тексты всех ячеек очищаются одной
+    заменой символов, погрешность после «±» отбрасывается, нечисловые значения пропускаются"""
+    if not pairs:
+        return {}
+    cleaned = '\x00'.join(text for _, text in pairs).translate(_VALUE_CLEANUP).split('\x00')
+    composition = {}
+    for (element, _), text in zip(pairs, cleaned):
+        try:
+            composition[element] = float(text.split('±', 1)[0])
+        except ValueError:
+            continue
+    return composition
+
+
+class CompositionTableLayouts:
+    """Расположение данных в таблицах состава, общее для всех протоколов процесса.
+
+    Шаблон таблицы определяется по числу строк, тексту первой строки и
+    подписям в первом столбце всех строк. Для нового шаблона таблица читается
+    целиком один раз: строки заголовков — те, где не меньше двух ячеек
+    совпадают с обозначениями элементов, строка значений блока — строка
+    «Среднее» (пятая после заголовка в стандартном протоколе), а без подписей —
+    пятая после заголовка (value_row). Блок без такой строки не читается:
+    отдельное измерение не подставляется вместо среднего. Следующие таблицы
+    того же шаблона читаются только по строкам заголовков и значений; если
+    заголовки не совпали, расположение определяется заново.
+    """
+
+    value_row_offset = 5
+
+    def __init__(self, elements=ALL_ELEMENTS, max_layouts=64):
+        self.elements = frozenset(elements)
+        self.max_layouts = max_layouts
+        self._layouts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def header_columns(self, cells):
+        return tuple((column, text) for column, text in enumerate(cells) if text in self.elements)
+
+    @staticmethod
+    def row_label(cells):
+        return cells[0] if cells else ''
+
+    def value_row(self, labels, header_row, end):
+        """Строка значений блока строк header_row..end-1 по подписям первого столбца или None"""
+        labelled = [index for index in range(header_row + 1, end) if 'сред' in labels[index].lower()]
+        value_row = header_row + self.value_row_offset
+        if value_row in labelled:
+            return value_row
+        if labelled:
+            return labelled[0]
+        return value_row if value_row < end else None
+
+    def detect(self, rows):
+        """Блоки (строка заголовков, строка значений, ((столбец, элемент), ...)) по всем строкам таблицы"""
+        headers = [(index, columns) for index, columns in ((i, self.header_columns(row)) for i, row in enumerate(rows))
+                   if len(columns) >= 2]
+        labels = [self.row_label(row) for row in rows]
+        blocks = []
+        for number, (header_row, columns) in enumerate(headers):
+            end = headers[number + 1][0] if number + 1 < len(headers) else len(rows)
+            value_row = self.value_row(labels, header_row, end)
+            if value_row is not None:
+                blocks.append((header_row, value_row, columns))
+        return tuple(blocks)
+
+    @staticmethod
+    def _read(layout, read_row, first_row):
+        """Пары (элемент, текст значения) или None, если заголовки не совпали с шаблоном"""
+        pairs = []
+        for header_row, value_row, columns in layout:
+            header = first_row if header_row == 0 else read_row(header_row)
+            if any(column >= len(header) or header[column] != element for column, element in columns):
+                return None
+            values = read_row(value_row)
+            pairs.extend((element, values[column]) for column, element in columns if column < len(values))
+        return pairs
+
+    def values(self, row_count, read_row, read_label):
+        """Пары (элемент, текст значения) таблицы из row_count строк; read_row(i) — ячейки строки i,
+        read_label(i) — текст её первой ячейки. None, если в таблице нет строк заголовков элементов"""
+        if row_count == 0:
+            return None
+        first_row = read_row(0)
+        # Подписи первого столбца отличают шаблоны с одинаковой первой строкой, но разными строками «Среднее»
+        key = (row_count, tuple(first_row), tuple(read_label(index) for index in range(row_count)))
+        layout = self._layouts.get(key)
+        if layout is not None:
+            pairs = self._read(layout, read_row, first_row) if layout else None
+            if pairs is not None or not layout:
+                self.hits += 1
+                return pairs
+
+        self.misses += 1
+        rows = [first_row] + [read_row(index) for index in range(1, row_count)]
+        layout = self.detect(rows)
+        with self._lock:
+            self._layouts[key] = layout
+            self._layouts.move_to_end(key)
+            while len(self._layouts) > self.max_layouts:
+                self._layouts.popitem(last=False)
+        return self._read(layout, rows.__getitem__, first_row) if layout else None
+
+    def stats(self):
+        return {'layouts': len(self._layouts), 'hits': self.hits, 'misses': self.misses}
+
+
+TABLE_LAYOUTS = CompositionTableLayouts()
+
+
+class ProtocolCache:
+    """LRU-кэш разобранных протоколов, ключ — хэш содержимого файла.
+    Может использоваться фоновым разбором (IngestionJob) одновременно с основным потоком"""
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def content_key(file_content):
+        return hashlib.sha256(file_content).hexdigest()
+
+    @staticmethod
+    def _estimate_size(samples):
+        return len(json.dumps(samples, ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def _copy_samples(samples):
+        return [dict(sample, composition=dict(sample.get('composition', {}))) for sample in samples]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return self._copy_samples(entry[0])
+
+    def put(self, key, samples):
+        size = self._estimate_size(samples)
+        copied = self._copy_samples(samples)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (copied, size)
+            self.current_bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+def manual_conflict_message(selected_name, sample):
+    return (
+        f"Название '{selected_name}' выбрано для нескольких образцов. "
+        f"Для '{sample['original_name']}' сопоставление пропущено."
+    )
+
+
+def with_manual_match(sample, selected_name, correct_dict, conflict=False):
+    """Копия образца с применённым ручным выбором. conflict — название уже занято
+    образцом, стоящим раньше в списке"""
+    updated_sample = sample.copy()
+    if selected_name and selected_name in correct_dict and not conflict:
+        updated_sample['name'] = selected_name
+        updated_sample['correct_number'] = correct_dict[selected_name]['number']
+        updated_sample['manually_matched'] = True
+        updated_sample['automatically_matched'] = False
+        updated_sample['match_stage'] = 'ручное сопоставление'
+    elif not conflict and sample.get('automatically_matched'):
+        updated_sample['manually_matched'] = False
+    else:
+        updated_sample['name'] = sample['original_name']
+        updated_sample['correct_number'] = None
+        updated_sample['manually_matched'] = False
+        updated_sample['automatically_matched'] = False
+    return updated_sample
+
+
+class ManualMatchOverlay:
+    """Ручные сопоставления поверх автоматических с запоминанием результата.
+
+    Результат хранится для пары (версия образцов, версия ручных сопоставлений).
+    Если изменились только отдельные выборы, пересчитываются образцы с этими
+    исходными названиями и образцы, претендующие на те же правильные названия:
+    у них может измениться конфликт. Название получает первый по порядку образец.
+    """
+
+    def __init__(self):
+        self.samples_version = None
+        self.manual_version = None
+        self.last_updated = 0
+        self._manual = {}
+        self._correct_dict = {}
+        self._samples = []
+        self._result = []
+        self._indices = {}
+        self._claims = {}
+        self._conflicts = set()
+
+    def apply(self, samples, correct_samples, manual_matches, samples_version, manual_version, diagnostics=None):
+        if samples_version != self.samples_version:
+            self._rebuild(samples, correct_samples, manual_matches)
+        elif manual_version != self.manual_version:
+            self._update(manual_matches)
+        else:
+            self.last_updated = 0
+        self.samples_version = samples_version
+        self.manual_version = manual_version
+
+        if diagnostics is not None:
+            for index in sorted(self._conflicts):
+                diagnostics.warning(manual_conflict_message(self._manual[self._samples[index]['original_name']], self._samples[index]))
+        return self._result
+
+    def _selection(self, index):
+        selected_name = self._manual.get(self._samples[index]['original_name'])
+        return selected_name if selected_name and selected_name in self._correct_dict else None
+
+    def _recompute(self, index):
+        selected_name = self._selection(index)
+        conflict = selected_name is not None and self._claims[selected_name][0] != index
+        if conflict:
+            self._conflicts.add(index)
+        else:
+            self._conflicts.discard(index)
+        self._result[index] = with_manual_match(
+            self._samples[index], self._manual.get(self._samples[index]['original_name']), self._correct_dict, conflict
+        )
+
+    def _rebuild(self, samples, correct_samples, manual_matches):
+        self._samples = list(samples)
+        self._correct_dict = {cs['original']: cs for cs in correct_samples or []}
+        self._manual = dict(manual_matches)
+        self._result = [None] * len(self._samples)
+        self._indices = {}
+        self._claims = {}
+        self._conflicts = set()
+        for index, sample in enumerate(self._samples):
+            self._indices.setdefault(sample['original_name'], []).append(index)
+            selected_name = self._selection(index)
+            if selected_name is not None:
+                self._claims.setdefault(selected_name, []).append(index)
+        for index in range(len(self._samples)):
+            self._recompute(index)
+        self.last_updated = len(self._samples)
+
+    def _update(self, manual_matches):
+        changed = {
+            name for name in set(self._manual) | set(manual_matches)
+            if self._manual.get(name) != manual_matches.get(name)
+        }
+        affected_names = set()
+        affected = set()
+        for original_name in changed:
+            indices = self._indices.get(original_name, [])
+            old_selection = self._selection(indices[0]) if indices else None
+            if old_selection is not None:
+                claims = self._claims[old_selection]
+                for index in indices:
+                    claims.remove(index)
+                if not claims:
+                    del self._claims[old_selection]
+                affected_names.add(old_selection)
+            if original_name in manual_matches:
+                self._manual[original_name] = manual_matches[original_name]
+            else:
+                self._manual.pop(original_name, None)
+            new_selection = self._selection(indices[0]) if indices else None
+            if new_selection is not None:
+                claims = self._claims.setdefault(new_selection, [])
+                for index in indices:
+                    bisect.insort(claims, index)
+                affected_names.add(new_selection)
+            affected.update(indices)
+        for selected_name in affected_names:
+            affected.update(self._claims.get(selected_name, []))
+
+        # Новый список, чтобы не менять результат, уже отданный вызывающей стороне
+        self._result = list(self._result)
+        for index in affected:
+            self._recompute(index)
+        self.last_updated = len(affected)
+
+
+# Версия результата разбора протоколов. Увеличивается при каждом изменении того,
+# какие образцы и значения состава получаются из файла: протоколы, сохранённые
+# в SampleStore другой версией, считаются отсутствующими и разбираются заново
+PARSER_VERSION = 4
+
+_SAMPLE_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS protocols (
+    file_hash TEXT PRIMARY KEY,
+    sample_count INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    parser_version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS protocols_last_used ON protocols (last_used);
+CREATE TABLE IF NOT EXISTS samples (
+    file_hash TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    steel_grade TEXT,
+    PRIMARY KEY (file_hash, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS compositions (
+    file_hash TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    element_order INTEGER NOT NULL,
+    element TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (file_hash, position, element_order)
+) WITHOUT ROWID;
+"""
+
+
+class SampleStore:
+    """Хранилище разобранных протоколов в SQLite, ключ — хэш содержимого файла
+    (ProtocolCache.content_key).
+
+    Сохраняет образцы каждого протокола (название, марка стали, химический
+    состав), чтобы повторно загружаемые файлы не разбирались заново, в том
+    числе в новых сессиях. Протокол, сохранённый с другой parser_version,
+    не возвращается и при следующей записи заменяется. Соединение открывается
+    на каждую операцию, поэтому хранилище можно использовать из разных потоков
+    и процессов. Ошибки SQLite не прерывают разбор: они попадают в diagnostics,
+    а протоколы разбираются как без хранилища.
+    """
+
+    # Ограничение на число параметров в одном запросе SQLite
+    batch_size = 500
+
+    def __init__(self, path, parser_version=PARSER_VERSION):
+        self.path = path
+        self.parser_version = parser_version
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SAMPLE_STORE_SCHEMA)
+            # Хранилища, созданные до появления версии разбора: их протоколы получают версию 0
+            if 'parser_version' not in {row[1] for row in conn.execute('PRAGMA table_info(protocols)')}:
+                conn.execute('ALTER TABLE protocols ADD COLUMN parser_version INTEGER NOT NULL DEFAULT 0')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _report(self, diagnostics, action, error):
+        message = f"Хранилище образцов {self.path}: ошибка при {action}: {error}"
+        if diagnostics is not None:
+            diagnostics.warning(message)
+        else:
+            logger.warning(message)
+
+    def get_many(self, keys, diagnostics=None):
+        """Образцы сохранённых протоколов: словарь ключ → список образцов, только для найденных ключей"""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        try:
+            with self._connect() as conn:
+                for start in range(0, len(keys), self.batch_size):
+                    batch = keys[start:start + self.batch_size]
+                    current = (
+                        f"SELECT file_hash FROM protocols "
+                        f"WHERE file_hash IN ({','.join('?' * len(batch))}) AND parser_version = ?"
+                    )
+                    params = batch + [self.parser_version]
+                    rows = {}
+                    for file_hash, position, name, steel_grade in conn.execute(
+                        f"SELECT file_hash, position, name, steel_grade FROM samples "
+                        f"WHERE file_hash IN ({current}) ORDER BY file_hash, position", params
+                    ):
+                        sample = {'name': name, 'steel_grade': steel_grade, 'composition': {}, 'original_name': name}
+                        rows[file_hash, position] = sample
+                        found.setdefault(file_hash, []).append(sample)
+                    for file_hash, position, element, value in conn.execute(
+                        f"SELECT file_hash, position, element, value FROM compositions "
+                        f"WHERE file_hash IN ({current}) ORDER BY file_hash, position, element_order", params
+                    ):
+                        rows[file_hash, position]['composition'][element] = value
+                if found:
+                    now = time.time()
+                    conn.executemany(
+                        "UPDATE protocols SET last_used = ? WHERE file_hash = ?", [(now, key) for key in found]
+                    )
+        except sqlite3.Error as e:
+            self._report(diagnostics, 'чтении', e)
+            return {}
+        return found
+
+    def put_many(self, items, diagnostics=None):
+        """Сохранение пар (ключ, образцы); пустые результаты разбора не сохраняются"""
+        items = [(key, samples) for key, samples in dict(items).items() if samples]
+        if not items:
+            return
+        now = time.time()
+        keys = [(key,) for key, _ in items]
+        try:
+            with self._connect() as conn:
+                conn.executemany("DELETE FROM samples WHERE file_hash = ?", keys)
+                conn.executemany("DELETE FROM compositions WHERE file_hash = ?", keys)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO protocols (file_hash, sample_count, stored_at, last_used, parser_version) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(key, len(samples), now, now, self.parser_version) for key, samples in items]
+                )
+                conn.executemany(
+                    "INSERT INTO samples (file_hash, position, name, steel_grade) VALUES (?, ?, ?, ?)",
+                    [
+                        (key, position, sample['name'], sample.get('steel_grade'))
+                        for key, samples in items for position, sample in enumerate(samples)
+                    ]
+                )
+                conn.executemany(
+                    "INSERT INTO compositions (file_hash, position, element_order, element, value) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (key, position, order, element, value)
+                        for key, samples in items for position, sample in enumerate(samples)
+                        for order, (element, value) in enumerate(sample.get('composition', {}).items())
+                    ]
+                )
+        except sqlite3.Error as e:
+            self._report(diagnostics, 'записи', e)
+
+    def put(self, key, samples, diagnostics=None):
+        self.put_many([(key, samples)], diagnostics=diagnostics)
+
+    def compact(self, max_files=None, max_age_days=None):
+        """Удаление протоколов другой версии разбора, не использовавшихся дольше
+        max_age_days, и всех, кроме max_files последних использованных, с
+        освобождением места в файле"""
+        removed = set()
+        with self._connect() as conn:
+            removed.update(row[0] for row in conn.execute(
+                "SELECT file_hash FROM protocols WHERE parser_version != ?", (self.parser_version,)
+            ))
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 86400
+                removed.update(row[0] for row in conn.execute(
+                    "SELECT file_hash FROM protocols WHERE last_used < ?", (cutoff,)
+                ))
+            if max_files is not None:
+                removed.update(row[0] for row in conn.execute(
+                    "SELECT file_hash FROM protocols ORDER BY last_used DESC LIMIT -1 OFFSET ?", (max_files,)
+                ))
+            keys = [(key,) for key in removed]
+            for table in ('compositions', 'samples', 'protocols'):
+                conn.executemany(f"DELETE FROM {table} WHERE file_hash = ?", keys)
+        # VACUUM нельзя выполнять внутри транзакции
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        return len(removed)
+
+    def stats(self):
+        with self._connect() as conn:
+            files, samples = conn.execute("SELECT COUNT(*), COALESCE(SUM(sample_count), 0) FROM protocols").fetchone()
+        size = sum(os.path.getsize(path) for path in (self.path, self.path + '-wal') if os.path.exists(path))
+        return {'files': files, 'samples': samples, 'bytes': size}
+
+
+class StagePipeline:
+    """Этапы обработки с явными входами. Результат этапа хранится вместе с его входами
+    и пересчитывается, только когда входы изменились. Объект живёт между перезапусками
+    веб-интерфейса, last_run показывает, какие этапы выполнялись в последнем проходе"""
+
+    def __init__(self, instrumentation=None):
+        self._stages = {}
+        self._versions = 0
+        self.last_run = []
+        self.instrumentation = instrumentation
+
+    def begin(self):
+        """Начало прохода по цепочке этапов"""
+        self.last_run = []
+
+    def run(self, name, inputs, compute, diagnostics=None):
+        """Результат этапа name: из сохранённого при тех же inputs или вызовом compute().
+        Сообщения, добавленные в diagnostics при расчёте, повторяются при повторном использовании"""
+        stage = self._stages.get(name)
+        if stage is not None and stage['inputs'] == inputs:
+            if diagnostics is not None:
+                # Без повторной записи в журнал
+                diagnostics.records.extend(dict(record) for record in stage['records'])
+            self.last_run.append({'stage': name, 'ran': False, 'seconds': 0.0, 'version': stage['version']})
+            if self.instrumentation is not None:
+                self.instrumentation.count(f'stage.{name}', hits=1)
+            return stage['result']
+
+        start_records = len(diagnostics.records) if diagnostics is not None else 0
+        start = time.perf_counter()
+        result = compute()
+        elapsed = time.perf_counter() - start
+        # Сквозная нумерация: версия не повторяется и после invalidate
+        self._versions += 1
+        version = self._versions
+        self._stages[name] = {
+            'inputs': inputs,
+            'result': result,
+            'version': version,
+            'records': [dict(record) for record in diagnostics.records[start_records:]] if diagnostics is not None else []
+        }
+        self.last_run.append({'stage': name, 'ran': True, 'seconds': elapsed, 'version': version})
+        if self.instrumentation is not None:
+            self.instrumentation.count(f'stage.{name}', misses=1)
+            self.instrumentation.record(f'stage.{name}', elapsed)
+        return result
+
+    def version(self, name):
+        """Номер версии результата этапа, 0 — этап ещё не выполнялся"""
+        stage = self._stages.get(name)
+        return stage['version'] if stage is not None else 0
+
+    def invalidate(self, name=None):
+        if name is None:
+            self._stages.clear()
+        else:
+            self._stages.pop(name, None)
+
+
+BUILTIN_STANDARDS = {
+    "12Х1МФ": {
+        "C": (0.10, 0.15), "Si": (0.17, 0.37), "Mn": (0.40, 0.70),
+        "Cr": (0.90, 1.20), "Mo": (0.25, 0.35), "V": (0.15, 0.30),
+        "Ni": (None, 0.25), "Cu": (None, 0.20), "S": (None, 0.025),
+        "P": (None, 0.025), "source": "ТУ 14-3Р-55-2001"
+    },
+    "12Х18Н12Т": {
+        "C": (None, 0.12), "Si": (None, 0.80), "Mn": (1.00, 2.00),
+        "Cr": (17.00, 19.00), "Ni": (11.00, 13.00), "Ti": (None, 0.70),
+        "Cu": (None, 0.30), "S": (None, 0.020), "P": (None, 0.035),
+        "source": "ТУ 14-3Р-55-2001"
+    },
+    "20": {
+        "C": (0.17, 0.24), "Si": (0.17, 0.37), "Mn": (0.35, 0.65),
+        "Cr": (None, 0.25), "Ni": (None, 0.25), "Cu": (None, 0.30),
+        "P": (None, 0.030), "S": (None, 0.025), "source": "ТУ 14-3Р-55-2001"
+    },
+    "Ди82": {
+        "C": (0.08, 0.12), "Si": (None, 0.5), "Mn": (0.30, 0.60),
+        "Cr": (8.60, 10.00), "Ni": (None, 0.70), "Mo": (0.60, 0.80),
+        "V": (0.10, 0.20), "Nb": (0.10, 0.20), "Cu": (None, 0.30),
+        "S": (None, 0.015), "P": (None, 0.03), "source": "ТУ 14-3Р-55-2001"
+    },
+    "Ди59": {
+        "C": (0.06, 0.10), "Si": (1.8, 2.2), "Mn": (12.00, 13.50),
+        "Cr": (11.50, 13.00), "Ni": (1.8, 2.5), "Nb": (0.60, 1.00),
+        "Cu": (2.00, 2.50), "S": (None, 0.02), "P": (None, 0.03),
+        "source": "ТУ 14-3Р-55-2001"
+    }
+}
+
+
+def report_elements(grade, standard):
+    """Порядок столбцов элементов в таблице отчёта для марки стали"""
+    if grade == '12Х1МФ':
+        main_elements = ['C', 'Si', 'Mn', 'Cr', 'Mo', 'V', 'Ni']
+        harmful_elements = ['Cu', 'S', 'P']
+    elif grade == '20':
+        main_elements = ['C', 'Si', 'Mn']
+        harmful_elements = ['P', 'S']
+    else:
+        return [elem for elem in standard.keys() if elem != 'source']
+    other_elements = [elem for elem in standard.keys() if elem not in main_elements + harmful_elements + ['source']]
+    return main_elements + other_elements + harmful_elements
+
+
+def compile_standard(grade, standard):
+    """Норматив марки в виде векторов границ по столбцам отчёта.
+
+    Отсутствующие границы — NaN, сравнение с ними всегда ложно, поэтому
+    такие элементы, как и в check_element_compliance, не дают отклонений.
+    Массивы доступны только для чтения: результат общий для всех сессий.
+    """
+    import numpy as np
+
+    elements = report_elements(grade, standard)
+    min_limits = np.full(len(elements), np.nan)
+    max_limits = np.full(len(elements), np.nan)
+    requirements = {}
+    for k, elem in enumerate(elements):
+        precision = 3 if elem in ['S', 'P'] else 2
+        if elem in standard:
+            min_val, max_val = standard[elem]
+            if min_val is not None:
+                min_limits[k] = min_val
+            if max_val is not None:
+                max_limits[k] = max_val
+            if min_val is not None and max_val is not None:
+                requirements[elem] = f"{min_val:.{precision}f}-{max_val:.{precision}f}".replace('.', ',')
+            elif min_val is not None:
+                requirements[elem] = f"≥{min_val:.{precision}f}".replace('.', ',')
+            elif max_val is not None:
+                requirements[elem] = f"≤{max_val:.{precision}f}".replace('.', ',')
+            else:
+                requirements[elem] = 'не нормируется'
+        else:
+            requirements[elem] = '-'
+
+    compiled = {
+        'elements': elements,
+        'min': min_limits,
+        'max': max_limits,
+        'precision3': np.array([elem in ['S', 'P'] for elem in elements], dtype=bool),
+        'requirements': requirements
+    }
+    for key in ('min', 'max', 'precision3'):
+        compiled[key].flags.writeable = False
+    return compiled
+
+
+class StandardsSnapshot:
+    """Неизменяемая версия нормативов с кэшем скомпилированных марок"""
+
+    def __init__(self, standards):
+        self.standards = standards
+        self.version = hashlib.sha256(
+            json.dumps(standards, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def compile(self, grade):
+        compiled = self._compiled.get(grade)
+        if compiled is None:
+            compiled = compile_standard(grade, self.standards[grade])
+            with self._lock:
+                compiled = self._compiled.setdefault(grade, compiled)
+        return compiled
+
+
+class StandardsRegistry:
+    """Нормативы марок стали, общие для всех сессий процесса.
+
+    Встроенные нормативы дополняются файлом path. Файл перечитывается, только
+    если изменились время его изменения или размер, а новый снимок нормативов
+    появляется, только если изменилось содержимое файла. Скомпилированные марки
+    хранятся в снимке и пересчитываются только для новой версии.
+    """
+
+    def __init__(self, path='user_standards.json', builtin=None):
+        self.path = path
+        self.builtin = builtin if builtin is not None else BUILTIN_STANDARDS
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._file_state = None
+        self._file_hash = None
+        self._snapshot = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def current(self):
+        with self._lock:
+            file_state = self._stat()
+            if self._snapshot is None or file_state != self._file_state:
+                self._refresh(file_state)
+            return self._snapshot
+
+    def _refresh(self, file_state):
+        content = None
+        if file_state is not None:
+            with open(self.path, 'rb') as f:
+                content = f.read()
+        file_hash = hashlib.sha256(content).hexdigest() if content is not None else None
+        if self._snapshot is None or file_hash != self._file_hash:
+            standards = {grade: dict(standard) for grade, standard in self.builtin.items()}
+            if content is not None:
+                standards.update(json.loads(content.decode('utf-8')))
+            self._snapshot = StandardsSnapshot(standards)
+            self._file_hash = file_hash
+            self.reloads += 1
+        # Состояние запоминается после успешного чтения: битый файл будет прочитан снова
+        self._file_state = file_state
+
+
+STANDARDS_REGISTRY = StandardsRegistry()
+
+
+class ChemicalAnalyzer:
+    def __init__(self, name_matcher=None, diagnostics=None, standards_registry=None, instrumentation=None):
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self.standards_registry = standards_registry or STANDARDS_REGISTRY
+        self.load_standards()
+        if instrumentation is None:
+            instrumentation = name_matcher.instrumentation if name_matcher is not None else Instrumentation()
+        self.instrumentation = instrumentation
+        self.name_matcher = name_matcher or SampleNameMatcher(diagnostics=self.diagnostics, instrumentation=instrumentation)
+        self.all_elements = list(ALL_ELEMENTS)
+        self.table_layouts = TABLE_LAYOUTS
+
+    def load_standards(self):
+        """Текущий снимок нормативов из общего реестра; словарь нормативов общий, его нельзя изменять"""
+        snapshot = self.standards_registry.current()
+        self._standards_snapshot = snapshot
+        self.standards = snapshot.standards
+        self.standards_version = snapshot.version
+
+    def extract_steel_grade_from_text(self, text):
+        """Извлекает марку стали из разных формулировок в протоколе"""
+        if not text:
+            return None
+
+        patterns = [
+            r'марке\s+стали\s*:\s*([^,;\n]+)',
+            r'близок\s+к\s+марке\s+стали\s*:\s*([^,;\n]+)',
+            r'соответствует\s+марке\s+стали\s*:\s*([^,;\n]+)',
+        ]
+
+        for pattern in patterns:
+            match = re.search(pattern, text, flags=re.IGNORECASE)
+            if match:
+                grade_text = match.group(1).strip()
+                grade_text = re.sub(r'\*+', '', grade_text).strip()
+                grade_text = grade_text.split(',')[0].strip()
+                return grade_text or None
+        return None
+
+    def parse_protocol_file(self, file_content):
+        try:
+            with self.instrumentation.timed('parse_protocol_file', bytes=len(file_content)):
+                return self.parse_protocol_document(file_content)
+        except Exception as e:
+            self.diagnostics.error(f"Ошибка при парсинге файла: {str(e)}")
+            return []
+
+    def parse_protocol_document(self, file_content):
+        """Разбор протокола без обработки ошибок — исключения передаются вызывающему.
+
+        Сначала используется потоковый разбор document.xml, при нестандартной
+        разметке — разбор через объектную модель python-docx.
+        """
+        samples = self.parse_protocol_xml(file_content)
+        if samples is None:
+            samples = self.parse_protocol_docx(file_content)
+        return samples
+
+    def parse_protocol_xml(self, file_content):
+        """Потоковый разбор word/document.xml через lxml.iterparse.
+
+        Читаются только абзацы верхнего уровня, строки 0/5/7/12 таблиц и
+        подписи первого столбца. Возвращает None, если разметка отличается от
+        ожидаемой или по подписям строками значений были бы не 5 и 12.
+        """
+        try:
+            with zipfile.ZipFile(io.BytesIO(file_content)) as archive:
+                with archive.open('word/document.xml') as stream:
+                    paragraphs, tables = _scan_protocol_xml(stream)
+        except (zipfile.BadZipFile, KeyError, etree.XMLSyntaxError, _UnexpectedLayout):
+            return None
+
+        samples = []
+        current_sample = None
+        for text in paragraphs:
+            if "Наименование образца:" in text:
+                sample_name = text.split("Наименование образца:", 1)[1].strip()
+                current_sample = {
+                    "name": sample_name,
+                    "steel_grade": None,
+                    "composition": {},
+                    "original_name": sample_name
+                }
+                samples.append(current_sample)
+                continue
+
+            grade_text = self.extract_steel_grade_from_text(text)
+            if grade_text and current_sample:
+                current_sample["steel_grade"] = grade_text
+
+        layouts = self.table_layouts
+        for sample, (row_count, rows, labels) in zip(samples, tables):
+            if (row_count < 13 or not self._is_header_row(rows[0]) or not self._is_header_row(rows[7])
+                    or layouts.value_row(labels, 0, 7) != 5 or layouts.value_row(labels, 7, row_count) != 12):
+                # Таблицы другого шаблона разбирает основной парсер по найденному расположению строк
+                return None
+            sample["composition"] = self.composition_from_rows(rows[0], rows[5], rows[7], rows[12])
+
+        return samples
+
+    def parse_protocol_docx(self, file_content):
+        """Разбор протокола через объектную модель python-docx"""
+        from docx import Document
+
+        doc = Document(io.BytesIO(file_content))
+        samples = []
+        current_sample = None
+
+        for paragraph in doc.paragraphs:
+            text = paragraph.text.strip()
+            if not text:
+                continue
+
+            if "Наименование образца:" in text:
+                sample_name = text.split("Наименование образца:", 1)[1].strip()
+                current_sample = {
+                    "name": sample_name,
+                    "steel_grade": None,
+                    "composition": {},
+                    "original_name": sample_name
+                }
+                samples.append(current_sample)
+                continue
+
+            grade_text = self.extract_steel_grade_from_text(text)
+            if grade_text and current_sample:
+                current_sample["steel_grade"] = grade_text
+
+        table_index = 0
+        for table in doc.tables:
+            if table_index < len(samples):
+                composition = self.parse_composition_table(table)
+                samples[table_index]["composition"] = composition
+                table_index += 1
+
+        return samples
+
+    def parse_composition_table(self, table):
+        """Состав по таблице python-docx: читаются только строки заголовков и значений
+        из расположения, найденного для шаблона таблицы (CompositionTableLayouts)"""
+        try:
+            rows = table._tbl.tr_lst
+
+            def read_row(index):
+                try:
+                    return _xml_row_cells(rows[index])
+                except _UnexpectedLayout:
+                    # Объединённые по вертикали ячейки python-docx разворачивает сам
+                    return [cell.text.strip() for cell in table.rows[index].cells]
+
+            def read_label(index):
+                try:
+                    return _xml_row_label(rows[index])
+                except _UnexpectedLayout:
+                    return CompositionTableLayouts.row_label([cell.text.strip() for cell in table.rows[index].cells])
+
+            pairs = self.table_layouts.values(len(rows), read_row, read_label)
+            if pairs is None:
+                if len(rows) < 13:
+                    self.diagnostics.warning(f"Таблица имеет только {len(rows)} строк, ожидалось минимум 13")
+                else:
+                    self.diagnostics.warning("В таблице не найдены строки с обозначениями элементов")
+                return {}
+            return parse_composition_values(pairs)
+        except Exception as e:
+            self.diagnostics.error(f"Ошибка при парсинге таблицы: {str(e)}")
+            return {}
+
+    def _is_header_row(self, cells):
+        return sum(1 for text in cells if text in self.all_elements) >= 2
+
+    def composition_from_rows(self, headers_row1, values_row1, headers_row2, values_row2):
+        """Состав по строкам заголовков (0 и 7) и значений (5 и 12) таблицы протокола"""
+        pairs = []
+        for headers, values in ((headers_row1, values_row1), (headers_row2, values_row2)):
+            pairs.extend(
+                (header, values[i]) for i, header in enumerate(headers)
+                if header in self.all_elements and i < len(values)
+            )
+        return parse_composition_values(pairs)
+
+    def match_sample_names(self, samples, correct_samples):
+        """Сопоставление образцов протоколов с правильными названиями.
+
+        Сопоставленные образцы получают правильное название и номер, остальные
+        возвращаются после них без номера.
+        """
+        if not correct_samples:
+            return samples
+
+        matched_pairs, unmatched_protocol = self.name_matcher.match_samples(samples, correct_samples)
+
+        matched_samples = []
+        for protocol_sample, correct_sample, match_stage in matched_pairs:
+            corrected_sample = protocol_sample.copy()
+            corrected_sample['original_name'] = protocol_sample['name']
+            corrected_sample['name'] = correct_sample['original']
+            corrected_sample['correct_number'] = correct_sample['number']
+            corrected_sample['automatically_matched'] = True
+            corrected_sample['manually_matched'] = False
+            corrected_sample['match_stage'] = match_stage
+            matched_samples.append(corrected_sample)
+
+        unmatched_samples = []
+        for sample in unmatched_protocol:
+            updated = sample.copy()
+            updated['original_name'] = sample['name']
+            updated['name'] = sample['name']
+            updated['correct_number'] = None
+            updated['automatically_matched'] = False
+            updated['manually_matched'] = False
+            unmatched_samples.append(updated)
+
+        return matched_samples + unmatched_samples
+
+    def apply_manual_matches(self, samples, correct_dict, manual_matches):
+        """Применение ручных сопоставлений к образцам"""
+        updated_samples = []
+        assigned_correct_names = set()
+
+        for sample in samples:
+            selected_name = manual_matches.get(sample['original_name'])
+            conflict = False
+            if selected_name and selected_name in correct_dict:
+                conflict = selected_name in assigned_correct_names
+                assigned_correct_names.add(selected_name)
+                if conflict:
+                    self.diagnostics.warning(manual_conflict_message(selected_name, sample))
+            updated_samples.append(with_manual_match(sample, selected_name, correct_dict, conflict))
+
+        return updated_samples
+
+    def check_element_compliance(self, element, value, standard):
+        if element not in standard or element == 'source':
+            return 'normal'
+        min_val, max_val = standard[element]
+        if min_val is not None and value < min_val:
+            return 'deviation'
+        if max_val is not None and value > max_val:
+            return 'deviation'
+        return 'normal'
+
+    def compile_standard(self, grade):
+        """Скомпилированный норматив марки из текущего снимка реестра нормативов"""
+        return self._standards_snapshot.compile(grade)
+
+    @staticmethod
+    def format_values(values, precision3):
+        """Форматирование матрицы значений с запятой: 3 знака для S и P, 2 для остальных, '-' для пропусков"""
+        import numpy as np
+
+        formatted = np.where(
+            precision3,
+            np.char.mod('%.3f', values),
+            np.char.mod('%.2f', values)
+        )
+        formatted = np.char.replace(formatted, '.', ',')
+        return np.where(np.isnan(values), '-', formatted).astype(object)
+
+    def create_report_tables(self, samples, manual_matches=None, correct_samples=None):
+        if not samples:
+            return None
+        with self.instrumentation.timed('create_report_tables', samples=len(samples)):
+            return self._create_report_tables(samples, manual_matches, correct_samples)
+
+    def _create_report_tables(self, samples, manual_matches, correct_samples):
+        import numpy as np
+        import pandas as pd
+
+        if manual_matches and correct_samples:
+            correct_dict = {cs['original']: cs for cs in correct_samples}
+            samples = self.apply_manual_matches(samples, correct_dict, manual_matches)
+
+        matched_samples = [s for s in samples if s.get('correct_number') is not None]
+        if not matched_samples:
+            self.diagnostics.warning("❌ Нет сопоставленных образцов для создания таблиц")
+            return None
+
+        steel_grades = list(set(sample['steel_grade'] for sample in matched_samples if sample['steel_grade']))
+        tables = {}
+
+        for grade in steel_grades:
+            if grade not in self.standards:
+                self.diagnostics.warning(f"Нет нормативов для марки стали: {grade}")
+                continue
+
+            compiled = self.compile_standard(grade)
+            elements = compiled['elements']
+            sorted_samples = sorted(
+                (s for s in matched_samples if s['steel_grade'] == grade),
+                key=lambda x: x.get('correct_number', float('inf'))
+            )
+
+            # Матрица образцы × элементы, пропуски — NaN
+            values = pd.DataFrame.from_records(
+                [s['composition'] for s in sorted_samples], columns=elements
+            ).to_numpy(dtype=float, na_value=np.nan)
+            with np.errstate(invalid='ignore'):
+                deviations = (values < compiled['min']) | (values > compiled['max'])
+            formatted = self.format_values(values, compiled['precision3'])
+
+            requirements_row = {'№': '', 'Образец': f'Требования ТУ 14-3Р-55-2001 для стали марки {grade}'}
+            requirements_row.update(compiled['requirements'])
+
+            columns = {
+                '№': list(range(1, len(sorted_samples) + 1)) + [''],
+                'Образец': [s['name'] for s in sorted_samples] + [requirements_row['Образец']]
+            }
+            for k, elem in enumerate(elements):
+                columns[elem] = list(formatted[:, k]) + [requirements_row[elem]]
+
+            statuses = np.where(deviations, 'deviation', 'normal').astype(object)
+            compliance = pd.DataFrame(
+                np.column_stack([np.full((len(sorted_samples), 2), 'normal', dtype=object), statuses]),
+                columns=['№', 'Образец'] + elements
+            )
+            compliance.loc[len(sorted_samples)] = 'requirements'
+
+            tables[grade] = {
+                'data': pd.DataFrame(columns),
+                'compliance': compliance,
+                'deviations': deviations,
+                'samples': sorted_samples,
+                'requirements': requirements_row
+            }
+
+        return tables
+
+    # Оформление ячеек по статусу соответствия
+    STATUS_CSS = {
+        'deviation': 'background-color: #ffcccc; color: #cc0000; font-weight: bold',
+        'requirements': 'background-color: #f0f0f0; font-style: italic'
+    }
+
+    def compliance_css(self, compliance_data):
+        """Таблица CSS-стилей той же формы, что и таблица статусов"""
+        import numpy as np
+        import pandas as pd
+
+        statuses = compliance_data.to_numpy()
+        css = np.full(statuses.shape, '', dtype=object)
+        for status, style in self.STATUS_CSS.items():
+            css[statuses == status] = style
+        return pd.DataFrame(css, index=compliance_data.index, columns=compliance_data.columns)
+
+    def apply_styling(self, df, compliance_data):
+        """Оформление таблицы за один проход Styler.apply. Стили вычисляются при выводе
+        таблицы, поэтому здесь замеряется только подготовка CSS"""
+        with self.instrumentation.timed('apply_styling', rows=len(df)):
+            css = self.compliance_css(compliance_data).reindex(index=df.index, columns=df.columns, fill_value='')
+            return df.style.apply(lambda _: css, axis=None)
+
+    @staticmethod
+    def flagged_rows(table_data):
+        """Позиции строк с отклонениями и строки требований"""
+        import numpy as np
+
+        rows = np.flatnonzero(table_data['deviations'].any(axis=1))
+        return np.append(rows, len(table_data['samples']))
+
+
+_worker_analyzer = None
+
+
+def _init_protocol_worker():
+    global _worker_analyzer
+    _worker_analyzer = ChemicalAnalyzer()
+
+
+def _parse_protocol_worker(file_content):
+    # Предупреждения, накопленные при разборе, передаются в основной процесс вместе с образцами
+    _worker_analyzer.diagnostics.drain()
+    try:
+        samples = _worker_analyzer.parse_protocol_document(file_content)
+    except Exception:
+        _worker_analyzer.diagnostics.drain()
+        raise
+    return samples, _worker_analyzer.diagnostics.drain()
+
+
+_worker_fuzzy_index = None
+
+
+def _init_fuzzy_worker(names):
+    global _worker_fuzzy_index
+    _worker_fuzzy_index = FuzzyNameIndex(names)
+
+
+def _fuzzy_matches_worker(texts, threshold, limit):
+    return [_worker_fuzzy_index.matches(text, threshold, limit) for text in texts]
+
+
+def fuzzy_matches_parallel(names, texts, threshold, limit, max_workers=None, chunk_size=200):
+    """FuzzyNameIndex(names).matches для каждого из texts в пуле процессов, в порядке texts.
+    Индекс строится в каждом процессе один раз, тексты передаются частями по chunk_size"""
+    chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(chunks)))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_fuzzy_worker, initargs=(names,)) as pool:
+        results = pool.map(_fuzzy_matches_worker, chunks, itertools.repeat(threshold), itertools.repeat(limit))
+        return [matches for chunk in results for matches in chunk]
+
+
+def parse_protocol_files_parallel(file_contents, max_workers=None, progress_callback=None, diagnostics=None):
+    """Параллельный разбор протоколов в пуле процессов.
+
+    Возвращает список пар (образцы, текст ошибки) в порядке исходных файлов:
+    ошибка в одном файле не прерывает обработку остальных. Предупреждения
+    разбора добавляются в diagnostics с номером файла в file_index.
+    """
+    results = [None] * len(file_contents)
+    if not file_contents:
+        return results
+
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(file_contents)))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_protocol_worker) as pool:
+        futures = {pool.submit(_parse_protocol_worker, content): index for index, content in enumerate(file_contents)}
+        for done, future in enumerate(as_completed(futures), 1):
+            index = futures[future]
+            try:
+                samples, records = future.result()
+                results[index] = (samples, None)
+                if diagnostics is not None:
+                    for record in records:
+                        diagnostics.add(**dict(record, file_index=index))
+            except Exception as e:
+                results[index] = ([], str(e))
+            if progress_callback:
+                progress_callback(done, len(file_contents))
+    return results
+
+
+class IngestionJob:
+    """Загрузка набора протоколов в фоновом потоке.
+
+    Файлы берутся из ProtocolCache, затем одним запросом из SampleStore,
+    остальные разбираются по одному в том же потоке или в пуле процессов.
+    Вызывающая сторона периодически читает snapshot(): образцы готовых файлов в
+    порядке файлов, число готовых файлов и сообщения с именами файлов, — и
+    может обрабатывать их, не дожидаясь конца загрузки.
+    """
+
+    def __init__(self, files, protocol_cache=None, sample_store=None, parallel=False, max_workers=None,
+                 instrumentation=None):
+        """files — список пар (имя файла, содержимое)"""
+        self.names = [name for name, _ in files]
+        self.keys = [ProtocolCache.content_key(content) for _, content in files]
+        self.total = len(files)
+        self.protocol_cache = protocol_cache
+        self.sample_store = sample_store
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.completed = 0
+        self.finished = False
+        self.error = None
+        self._contents = [content for _, content in files]
+        self._results = [None] * self.total
+        self._records = []
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='protocol-ingestion', daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """Остановка после текущего файла; уже готовые результаты сохраняются"""
+        self._cancelled.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.finished
+
+    def snapshot(self):
+        """Согласованное состояние загрузки: samples, completed, total, finished, records"""
+        with self._lock:
+            return {
+                'samples': [sample for samples in self._results if samples is not None for sample in samples],
+                'completed': self.completed,
+                'total': self.total,
+                'finished': self.finished,
+                'records': [dict(record) for record in self._records],
+            }
+
+    def _complete(self, index, samples, records=()):
+        with self._lock:
+            self._results[index] = samples
+            self._records.extend(dict(record, file_name=self.names[index]) for record in records)
+            self.completed += 1
+
+    def _run(self):
+        try:
+            pending = []
+            for index, key in enumerate(self.keys):
+                samples = self.protocol_cache.get(key) if self.protocol_cache is not None else None
+                if samples is not None:
+                    self._complete(index, samples)
+                else:
+                    pending.append(index)
+
+            if self.sample_store is not None and pending:
+                diagnostics = Diagnostics()
+                stored = self.sample_store.get_many([self.keys[index] for index in pending], diagnostics=diagnostics)
+                with self._lock:
+                    self._records.extend(diagnostics.drain())
+                found = [index for index in pending if self.keys[index] in stored]
+                self.instrumentation.count('sample_store', hits=len(found), misses=len(pending) - len(found))
+                for index in found:
+                    if self.protocol_cache is not None:
+                        self.protocol_cache.put(self.keys[index], stored[self.keys[index]])
+                    # Отдельные копии: один и тот же файл может быть загружен дважды
+                    self._complete(index, [dict(sample, composition=dict(sample['composition']))
+                                           for sample in stored[self.keys[index]]])
+                pending = [index for index in pending if self.keys[index] not in stored]
+
+            if self.parallel and len(pending) > 1:
+                with self.instrumentation.timed('parse_protocol_files_parallel', files=len(pending)):
+                    parsed = self._parse_in_pool(pending)
+            else:
+                parsed = self._parse_in_thread(pending)
+
+            if self.sample_store is not None and parsed:
+                diagnostics = Diagnostics()
+                self.sample_store.put_many([(self.keys[index], self._results[index]) for index in parsed],
+                                           diagnostics=diagnostics)
+                with self._lock:
+                    self._records.extend(diagnostics.drain())
+        except Exception as e:
+            self.error = str(e)
+            record = Diagnostics().error(f"Ошибка при загрузке протоколов: {e}")
+            with self._lock:
+                self._records.append(record)
+        finally:
+            with self._lock:
+                self._contents = None
+                self.finished = True
+
+    def _finish_parse(self, index, samples, records):
+        if samples and self.protocol_cache is not None:
+            self.protocol_cache.put(self.keys[index], samples)
+        self._complete(index, samples, records)
+
+    def _parse_in_thread(self, pending):
+        analyzer = ChemicalAnalyzer(instrumentation=self.instrumentation)
+        parsed = []
+        for index in pending:
+            if self._cancelled.is_set():
+                break
+            content = self._contents[index]
+            try:
+                with self.instrumentation.timed('parse_protocol_file', bytes=len(content)):
+                    samples = analyzer.parse_protocol_document(content)
+                records = analyzer.diagnostics.drain()
+            except Exception as e:
+                samples = []
+                analyzer.diagnostics.error(f"Ошибка при парсинге файла: {e}")
+                records = analyzer.diagnostics.drain()
+            self._finish_parse(index, samples, records)
+            parsed.append(index)
+        return parsed
+
+    def _parse_in_pool(self, pending):
+        parsed = []
+        max_workers = max(1, min(self.max_workers or os.cpu_count() or 1, len(pending)))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_protocol_worker) as pool:
+            futures = {pool.submit(_parse_protocol_worker, self._contents[index]): index for index in pending}
+            for future in as_completed(futures):
+                if self._cancelled.is_set():
+                    for other in futures:
+                        other.cancel()
+                    break
+                index = futures[future]
+                try:
+                    samples, records = future.result()
+                except Exception as e:
+                    samples, records = [], [Diagnostics().error(f"Ошибка при парсинге файла: {e}")]
+                self._finish_parse(index, samples, records)
+                parsed.append(index)
+        return parsed
+
+
+REPORT_FONT = 'Times New Roman'
+
+
+def set_font_times_new_roman(doc):
+    """Times New Roman во всех стилях и в настройках документа по умолчанию.
+    Шрифт задаётся один раз и наследуется всеми абзацами и таблицами"""
+    from docx.oxml.ns import qn
+
+    for style in doc.styles:
+        if hasattr(style, 'font'):
+            style.font.name = REPORT_FONT
+    # Шрифты темы имеют приоритет над явно заданным шрифтом стиля
+    for r_fonts in doc.styles.element.iter(qn('w:rFonts')):
+        for attr in ('w:asciiTheme', 'w:hAnsiTheme', 'w:cstheme'):
+            r_fonts.attrib.pop(qn(attr), None)
+        for attr in ('w:ascii', 'w:hAnsi', 'w:cs'):
+            r_fonts.set(qn(attr), REPORT_FONT)
+
+
+_OOXML_BREAKS = re.compile(r'(\t|\r\n|\n|\r)')
+
+
+def _ooxml_run(text):
+    """Разметка w:r для текста ячейки, как у python-docx: табуляции и переводы строк отдельными элементами"""
+    parts = []
+    for chunk in _OOXML_BREAKS.split(text):
+        if chunk == '\t':
+            parts.append('<w:tab/>')
+        elif chunk in ('\r\n', '\n', '\r'):
+            parts.append('<w:br/>')
+        elif chunk:
+            space = ' xml:space="preserve"' if chunk != chunk.strip() else ''
+            parts.append(f'<w:t{space}>{xml_escape(chunk)}</w:t>')
+    return f"<w:r>{''.join(parts)}</w:r>"
+
+
+def add_report_table(doc, df, style='Table Grid'):
+    """Таблица Word с заголовком из столбцов DataFrame. Строки собираются в OOXML
+    одним фрагментом вместо поячеечной записи через table.cell()"""
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls, qn
+
+    table = doc.add_table(rows=0, cols=len(df.columns))
+    table.style = style
+    widths = [col.get(qn('w:w')) for col in table._tbl.tblGrid.iter(qn('w:gridCol'))]
+
+    def row_xml(values):
+        cells = ''.join(
+            f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr><w:p>{_ooxml_run(str(value))}</w:p></w:tc>'
+            for width, value in zip(widths, values)
+        )
+        return f'<w:tr>{cells}</w:tr>'
+
+    rows = [row_xml(df.columns)]
+    rows.extend(row_xml(values) for values in df.itertuples(index=False, name=None))
+    fragment = parse_xml(f"<w:tbl {nsdecls('w')}>{''.join(rows)}</w:tbl>")
+    table._tbl.extend(list(fragment))
+    return table
+
+
+def build_word_report(samples, report_tables):
+    """Word-отчёт по готовым таблицам соответствия, возвращает содержимое .docx"""
+    from docx import Document
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+    doc = Document()
+    set_font_times_new_roman(doc)
+
+    title = doc.add_heading('Протокол анализа химического состава', 0)
+    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    doc.add_paragraph(f"Дата формирования: {datetime.now().strftime('%d.%m.%Y %H:%M')}")
+
+    matched_samples = [s for s in samples if s.get('correct_number') is not None]
+    doc.add_paragraph(f"Проанализировано образцов: {len(matched_samples)}")
+    doc.add_paragraph('')
+
+    doc.add_heading('Легенда', level=1)
+    legend_table = doc.add_table(rows=3, cols=2)
+    legend_table.style = 'Table Grid'
+    legend_table.cell(0, 0).text = 'Цвет'
+    legend_table.cell(0, 1).text = 'Значение'
+    legend_table.cell(1, 0).text = '🔴'
+    legend_table.cell(1, 1).text = 'Отклонение от норм'
+    legend_table.cell(2, 0).text = '⚪'
+    legend_table.cell(2, 1).text = 'Нормативные требования'
+    doc.add_paragraph()
+
+    for grade, table_data in report_tables.items():
+        doc.add_heading(f'Марка стали: {grade}', level=1)
+        add_report_table(doc, table_data['data'])
+        doc.add_paragraph()
+
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
+
+
+def report_file_name():
+    return f"химический_анализ_отчет_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
+
+
+class SampleExporter:
+    """Потоковая выгрузка образцов в CSV, Parquet или Arrow частями по chunk_size.
+
+    Каждая строка — образец: исходное и правильное название, номер и способ
+    сопоставления, марка стали, содержание всех элементов all_elements и
+    признаки отклонения по каждому элементу. Для марок без норматива признаки
+    пусты. Образцы можно передавать любым итерируемым объектом: в памяти
+    одновременно находится только одна часть.
+    """
+
+    info_columns = ['original_name', 'name', 'correct_number', 'match_stage', 'steel_grade']
+
+    def __init__(self, analyzer, chunk_size=5000):
+        self.analyzer = analyzer
+        self.chunk_size = chunk_size
+        self.elements = list(analyzer.all_elements)
+        self.flag_columns = [f'{elem}_deviation' for elem in self.elements]
+        self._limits = {}
+
+    @property
+    def columns(self):
+        return self.info_columns + self.elements + self.flag_columns + ['has_deviation']
+
+    def grade_limits(self, grade):
+        """Границы марки по столбцам all_elements или None, если норматива нет"""
+        if grade not in self._limits:
+            import numpy as np
+
+            limits = None
+            if grade in self.analyzer.standards:
+                compiled = self.analyzer.compile_standard(grade)
+                positions = {elem: k for k, elem in enumerate(self.elements)}
+                limits = (np.full(len(self.elements), np.nan), np.full(len(self.elements), np.nan))
+                for k, elem in enumerate(compiled['elements']):
+                    if elem in positions:
+                        limits[0][positions[elem]] = compiled['min'][k]
+                        limits[1][positions[elem]] = compiled['max'][k]
+            self._limits[grade] = limits
+        return self._limits[grade]
+
+    def frame(self, samples):
+        """Часть выгрузки для списка образцов"""
+        import numpy as np
+        import pandas as pd
+
+        values = np.array(
+            [[sample.get('composition', {}).get(elem) for elem in self.elements] for sample in samples],
+            dtype=float
+        ).reshape(len(samples), len(self.elements))
+        min_limits = np.full(values.shape, np.nan)
+        max_limits = np.full(values.shape, np.nan)
+        known = np.zeros(len(samples), dtype=bool)
+        grades = np.array([sample.get('steel_grade') for sample in samples], dtype=object)
+        for grade in set(grades):
+            limits = self.grade_limits(grade)
+            if limits is not None:
+                rows = grades == grade
+                min_limits[rows] = limits[0]
+                max_limits[rows] = limits[1]
+                known |= rows
+        with np.errstate(invalid='ignore'):
+            deviations = (values < min_limits) | (values > max_limits)
+
+        columns = {
+            'original_name': [sample.get('original_name', sample.get('name')) for sample in samples],
+            'name': [sample.get('name') for sample in samples],
+            'correct_number': pd.array([sample.get('correct_number') for sample in samples], dtype='Int64'),
+            'match_stage': [sample.get('match_stage') for sample in samples],
+            'steel_grade': list(grades),
+        }
+        for k, elem in enumerate(self.elements):
+            columns[elem] = values[:, k]
+        for k, column in enumerate(self.flag_columns):
+            columns[column] = pd.array(np.where(known, deviations[:, k], None), dtype='boolean')
+        columns['has_deviation'] = pd.array(np.where(known, deviations.any(axis=1), None), dtype='boolean')
+        return pd.DataFrame(columns)
+
+    def chunks(self, samples):
+        iterator = iter(samples)
+        while True:
+            batch = list(itertools.islice(iterator, self.chunk_size))
+            if not batch:
+                return
+            yield self.frame(batch)
+
+    def arrow_schema(self):
+        import pyarrow as pa
+
+        return pa.schema(
+            [(column, pa.string()) for column in ['original_name', 'name']]
+            + [('correct_number', pa.int64())]
+            + [(column, pa.string()) for column in ['match_stage', 'steel_grade']]
+            + [(elem, pa.float64()) for elem in self.elements]
+            + [(column, pa.bool_()) for column in self.flag_columns + ['has_deviation']]
+        )
+
+    def write_csv(self, samples, target):
+        """target — путь или открытый текстовый файл"""
+        with _open_target(target, 'w', encoding='utf-8', newline='') as f:
+            for index, chunk in enumerate(self.chunks(samples)):
+                chunk.to_csv(f, header=index == 0, index=False)
+        return target
+
+    def write_parquet(self, samples, target):
+        """target — путь или открытый двоичный файл"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = self.arrow_schema()
+        with pq.ParquetWriter(target, schema) as writer:
+            for chunk in self.chunks(samples):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        return target
+
+    def write_arrow(self, samples, target):
+        """Файл Arrow IPC (Feather v2); target — путь или открытый двоичный файл"""
+        import pyarrow as pa
+
+        schema = self.arrow_schema()
+        with pa.ipc.new_file(target, schema) as writer:
+            for chunk in self.chunks(samples):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        return target
+
+    def write(self, samples, path):
+        """Выгрузка в формате по расширению файла: .csv, .parquet, .arrow или .feather"""
+        extension = os.path.splitext(path)[1].lower()
+        writers = {
+            '.csv': self.write_csv,
+            '.parquet': self.write_parquet,
+            '.arrow': self.write_arrow,
+            '.feather': self.write_arrow,
+        }
+        if extension not in writers:
+            raise ValueError(f"Неизвестный формат выгрузки: {extension or path}")
+        return writers[extension](samples, path)
+
+
+@contextmanager
+def _open_target(target, mode, **kwargs):
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, mode, **kwargs) as f:
+            yield f
+    else:
+        yield target
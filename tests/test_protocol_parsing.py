@@ -0,0 +1,174 @@
+"""Потоковый разбор (parse_protocol_xml) и разбор через python-docx
+(parse_protocol_docx) на одних и тех же протоколах.
+
+Стандартные протоколы строятся benchmarks/synthetic.py; варианты с
+объединёнными ячейками (gridSpan, vMerge) и короткими таблицами — здесь же.
+Для вариантов, которые потоковый разбор передаёт python-docx (возвращает
+None), результат сверяется с составом, из которого построен протокол.
+"""
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from core import ChemicalAnalyzer, CompositionTableLayouts  # noqa: E402
+from synthetic import (  # noqa: E402
+    HEADERS, document_docx, format_value, make_dataset, paragraph_xml, protocol_docx
+)
+
+
+def make_analyzer():
+    # Свой кэш расположений: результат не должен зависеть от порядка тестов
+    analyzer = ChemicalAnalyzer()
+    analyzer.table_layouts = CompositionTableLayouts()
+    return analyzer
+
+
+def cell(text, span=1, merge=None):
+    properties = '<w:tcW w:type="dxa" w:w="900"/>'
+    if span > 1:
+        properties += f'<w:gridSpan w:val="{span}"/>'
+    if merge == 'restart':
+        properties += '<w:vMerge w:val="restart"/>'
+    elif merge == 'continue':
+        properties += '<w:vMerge/>'
+    return f'<w:tc><w:tcPr>{properties}</w:tcPr>{paragraph_xml(text)}</w:tc>'
+
+
+def table(rows, columns):
+    """Таблица из строк, каждая — список ячеек cell()"""
+    grid = ''.join('<w:gridCol w:w="900"/>' for _ in range(columns))
+    body = ''.join('<w:tr>' + ''.join(row) + '</w:tr>' for row in rows)
+    return (f'<w:tbl><w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/></w:tblPr>'
+            f'<w:tblGrid>{grid}</w:tblGrid>{body}</w:tbl>')
+
+
+def block_rows(headers, composition, measurements=3, average_offset=5, label_merge=False, first_span=1,
+               average_label='Среднее', uncertainty_rows=0):
+    """Строки блока: заголовок, подпись «Элемент», измерения, строка «Среднее» (с подписью
+    average_label) на average_offset, uncertainty_rows строк погрешности без подписи и пустая строка"""
+    rows = [[cell('', first_span)] + [cell(element) for element in headers[1:]]]
+    rows.append([cell('Элемент', first_span, 'restart' if label_merge else None)] + [cell('') for _ in headers[1:]])
+    for _ in range(measurements):
+        rows.append([cell('', first_span, 'continue' if label_merge else None)]
+                    + [cell(format_value(composition[element] * 1.01)) for element in headers[1:]])
+    while len(rows) < average_offset:
+        rows.append([cell('', first_span)] + [cell('') for _ in headers[1:]])
+    rows.append([cell(average_label, first_span, 'continue' if label_merge else None)]
+                + [cell(format_value(composition[element])) for element in headers[1:]])
+    for _ in range(uncertainty_rows):
+        rows.append([cell('', first_span)] + [cell(format_value(composition[element] * 0.05)) for element in headers[1:]])
+    rows.append([cell('', first_span)] + [cell('') for _ in headers[1:]])
+    return rows
+
+
+def table_rows(composition, **options):
+    """Два блока элементов; при параметрах по умолчанию — 13 строк, как в стандартном протоколе"""
+    return block_rows(HEADERS[0], composition, **options) + block_rows(HEADERS[1], composition, **options)[:-1]
+
+
+def protocol(samples, **options):
+    """Протокол с таблицами, построенными block_rows(**options)"""
+    columns = len(HEADERS[0]) + options.get('first_span', 1) - 1
+    parts = []
+    for sample in samples:
+        parts.append(paragraph_xml(f"Наименование образца: {sample['name']}"))
+        parts.append(paragraph_xml(f"Химический состав металла образца соответствует марке стали: {sample['steel_grade']}"))
+        parts.append(table(table_rows(sample['composition'], **options), columns))
+        parts.append(paragraph_xml(''))
+    return document_docx(''.join(parts))
+
+
+def parsed(samples):
+    """Название, марка и состав образцов — разобранных или исходных"""
+    return [(sample['name'], sample['steel_grade'], sample['composition']) for sample in samples]
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    _, protocols = make_dataset(40, seed=3, per_protocol=5)
+    return protocols
+
+
+def test_synthetic_protocols_same_in_both_parsers(dataset):
+    for index, samples in enumerate(dataset):
+        content = protocol_docx(samples, seed=index)
+        from_xml = make_analyzer().parse_protocol_xml(content)
+        assert from_xml is not None
+        assert parsed(from_xml) == parsed(make_analyzer().parse_protocol_docx(content))
+        assert parsed(from_xml) == parsed(samples)
+
+
+def test_grid_span_same_in_both_parsers(dataset):
+    content = protocol(dataset[0], first_span=2)
+    from_xml = make_analyzer().parse_protocol_xml(content)
+    assert from_xml is not None
+    assert parsed(from_xml) == parsed(make_analyzer().parse_protocol_docx(content))
+    assert parsed(from_xml) == parsed(dataset[0])
+
+
+def test_vertical_merge_parsed_by_docx(dataset):
+    content = protocol(dataset[1], label_merge=True)
+    # Объединение по вертикали в строке значений потоковый разбор не читает
+    assert make_analyzer().parse_protocol_xml(content) is None
+    assert parsed(make_analyzer().parse_protocol_docx(content)) == parsed(dataset[1])
+    assert parsed(make_analyzer().parse_protocol_document(content)) == parsed(dataset[1])
+
+
+def test_short_table_parsed_by_average_row(dataset):
+    content = protocol(dataset[2], measurements=2, average_offset=4)
+    assert make_analyzer().parse_protocol_xml(content) is None
+    assert parsed(make_analyzer().parse_protocol_docx(content)) == parsed(dataset[2])
+
+
+def test_cached_layout_does_not_replace_missing_average(dataset):
+    """Таблица без значений в строке «Среднее» не должна читаться по строке измерения
+    ни сама, ни через расположение, сохранённое для следующих таблиц того же шаблона"""
+    samples = [dict(sample) for sample in dataset[3][:2]]
+    analyzer = make_analyzer()
+    rows = table_rows(samples[0]['composition'], label_merge=True)
+    rows[5] = [cell('Среднее', merge='continue')] + [cell('-') for _ in HEADERS[0][1:]]
+    first = document_docx(
+        paragraph_xml(f"Наименование образца: {samples[0]['name']}") + table(rows, len(HEADERS[0])) + paragraph_xml('')
+    )
+    result = analyzer.parse_protocol_document(first)
+    assert set(result[0]['composition']) == set(HEADERS[1][1:])
+
+    second = protocol(samples[1:], label_merge=True)
+    assert parsed(analyzer.parse_protocol_document(second)) == parsed(samples[1:])
+
+
+def test_mixed_documents_share_layouts(dataset):
+    """Один кэш расположений для протоколов разных вариантов даёт те же составы, что и отдельные"""
+    analyzer = make_analyzer()
+    rnd = random.Random(0)
+    variants = [{}, {'label_merge': True}, {'measurements': 2, 'average_offset': 4}, {'first_span': 2}]
+    for _ in range(3):
+        for index, options in enumerate(variants):
+            samples = dataset[index]
+            content = protocol(samples, **options) if options or rnd.random() < 0.5 else protocol_docx(samples)
+            assert parsed(analyzer.parse_protocol_document(content)) == parsed(samples)
+
+
+def test_average_rows_before_offset_same_in_both_parsers(dataset):
+    """«Среднее» в строках 4 и 11, в строках 5 и 12 — погрешность без подписи"""
+    content = protocol(dataset[4], measurements=2, average_offset=4, uncertainty_rows=1)
+    from_xml = make_analyzer().parse_protocol_xml(content)
+    assert from_xml is None or parsed(from_xml) == parsed(dataset[4])
+    assert parsed(make_analyzer().parse_protocol_docx(content)) == parsed(dataset[4])
+    assert parsed(make_analyzer().parse_protocol_document(content)) == parsed(dataset[4])
+
+
+def test_unlabelled_template_does_not_hide_average_rows(dataset):
+    """Таблица со строками «Среднее» читается по ним и после таблицы того же размера
+    и с той же первой строкой, но без подписей, расположение которой уже в кэше"""
+    unlabelled, labelled = dataset[5][:1], dataset[5][1:2]
+    analyzer = make_analyzer()
+    assert parsed(analyzer.parse_protocol_docx(protocol(unlabelled, average_label=''))) == parsed(unlabelled)
+    content = protocol(labelled, measurements=2, average_offset=4, uncertainty_rows=1)
+    assert parsed(analyzer.parse_protocol_docx(content)) == parsed(labelled)